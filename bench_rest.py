@@ -0,0 +1,313 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmarks for SauceClient against the local fakesauce server.
+
+    $ python bench_rest.py create_jobs -n 2000 -c 1,4,16,64
+    $ python bench_rest.py get list create --error-rate 0.01
+
+Request benchmarks report requests/second, p50 and p99 latency in
+milliseconds, how much the peak RSS of the process grew, in KiB, and how
+many requests failed: "failed" after the server's errors, "refused" by an
+open circuit breaker without reaching the server. Every run gets a fresh
+client, so a breaker opened in one run doesn't fail the next one fast.
+"""
+
+import sys
+import time
+import logging
+import resource
+from optparse import OptionParser
+
+import metrics
+import saucerest
+from fakesauce import FakeSauce
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__[len('bench_'):]] = function
+    return function
+
+
+def _client(fake, **kwargs):
+    # with a RetryPolicy, and so circuit breakers, of its own
+    return saucerest.SauceClient(name='bench', access_key='bench',
+                                 base_url=fake.base_url,
+                                 retry_policy=saucerest.RetryPolicy(),
+                                 **kwargs)
+
+
+def _count_errors(errors):
+    """Return (failed, refused) for a list of errors, Nones included."""
+    refused = len([e for e in errors
+                   if isinstance(e, saucerest.CircuitOpenError)])
+    return len(errors) - errors.count(None) - refused, refused
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(function, count, concurrency):
+    """
+    Call function(i) for i in range(count) from concurrency threads.
+    Return (requests/sec, p50, p99, failed, refused, peak RSS growth).
+    """
+    def timed(i):
+        start = time.time()
+        result = function(i)
+        if isinstance(result, dict) and 'error' in result:
+            raise saucerest.SauceRestError(result['error'])
+        return time.time() - start
+
+    rss = _peak_rss()
+    latencies = []
+    errors = []
+    start = time.time()
+    for latency, error in saucerest._imap_ordered(timed, xrange(count),
+                                                  concurrency):
+        errors.append(error)
+        if error is None:
+            latencies.append(latency)
+    elapsed = time.time() - start
+    latencies.sort()
+    failed, refused = _count_errors(errors)
+    return (count / elapsed, _percentile(latencies, 0.5),
+            _percentile(latencies, 0.99), failed, refused, _peak_rss() - rss)
+
+
+def _report_header():
+    print "%11s %8s %10s %9s %9s %7s %7s %9s" % (
+        "concurrency", "requests", "req/sec", "p50 ms", "p99 ms", "failed",
+        "refused", "rss KiB")
+
+
+def _report(concurrency, count, result):
+    rate, p50, p99, failed, refused, rss = result
+    print "%11d %8d %10.1f %9.2f %9.2f %7d %7d %9d" % (
+        concurrency, count, rate, p50 * 1000, p99 * 1000, failed, refused,
+        rss)
+
+
+def _run(fake, options, function, **kwargs):
+    _report_header()
+    for concurrency in options.concurrency:
+        client = _client(fake, max_connections=concurrency, **kwargs)
+        _report(concurrency, options.count,
+                _measure(lambda i: function(client, i), options.count,
+                         concurrency))
+
+
+@benchmark
+def bench_get(fake, options):
+    """get() of a single tunnel"""
+    tunnel_id = _client(fake).create_tunnel({})['id']
+    _run(fake, options, lambda client, i: client.get('tunnels', tunnel_id))
+
+
+@benchmark
+def bench_list(fake, options):
+    """list() of jobs, with --list-size jobs on the server"""
+    client = _client(fake)
+    for i in xrange(options.list_size - len(fake.docs['jobs'])):
+        client.create('jobs', {'Name': 'listed job %d' % i})
+    _run(fake, options, lambda client, i: client.list('jobs'))
+
+
+@benchmark
+def bench_create(fake, options):
+    """create() of one job per request"""
+    _run(fake, options,
+         lambda client, i: client.create('jobs', {'Name': 'job %d' % i}))
+
+
+@benchmark
+def bench_create_jobs(fake, options):
+    """jobs/second submitted through create_jobs as concurrency grows"""
+    print "%11s %8s %10s %7s %7s" % ("concurrency", "jobs", "jobs/sec",
+                                     "failed", "refused")
+    for concurrency in options.concurrency:
+        client = _client(fake, max_connections=concurrency)
+        bodies = ({'Name': 'bench job %d' % i} for i in xrange(options.count))
+        start = time.time()
+        errors = [error for job, error in client.create_jobs(bodies,
+                                                             concurrency)]
+        elapsed = time.time() - start
+        print "%11d %8d %10.1f %7d %7d" % (
+            (concurrency, options.count, options.count / elapsed) +
+            _count_errors(errors))
+
+
+@benchmark
+def bench_wait_for_jobs(fake, options):
+    """wait_for_jobs() on batches of jobs running --job-duration seconds"""
+    client = _client(fake)
+    fake.job_duration, job_duration = options.job_duration, fake.job_duration
+    try:
+        print "%8s %10s %11s %9s %9s" % ("jobs", "seconds", "job seconds",
+                                         "requests", "rss KiB")
+        for size in options.concurrency:
+            batch = 'bench-%d-%f' % (size, time.time())
+            for i in xrange(size):
+                client.create('jobs', {'Name': 'job %d' % i, 'Batch': batch})
+            rss = _peak_rss()
+            requests = fake.requests
+            start = time.time()
+            client.wait_for_jobs(batch)
+            print "%8d %10.2f %11.2f %9d %9d" % (
+                size, time.time() - start, options.job_duration,
+                fake.requests - requests, _peak_rss() - rss)
+    finally:
+        fake.job_duration = job_duration
+
+
+@benchmark
+def bench_provision(fake, options):
+    """tunnelmonitor.get_new_tunnel() with tunnels booting --boot-time s"""
+    import tunnelmonitor
+    fake.boot_time, boot_time = options.boot_time, fake.boot_time
+    try:
+        _report_header()
+        for concurrency in options.concurrency:
+            client = _client(fake, max_connections=concurrency)
+            count = concurrency * 2
+            result = _measure(
+                lambda i: tunnelmonitor.get_new_tunnel(
+                    client, ['bench%d.example.com' % i], replace=False),
+                count, concurrency)
+            _report(concurrency, count, result)
+    finally:
+        fake.boot_time = boot_time
+
+
+@benchmark
+def bench_failover(fake, options):
+    """replacing a tunnel by booting a new one vs promoting a standby"""
+    import tunnelmonitor
+    fake.boot_time, boot_time = options.boot_time, fake.boot_time
+    try:
+        client = _client(fake)
+        pool = tunnelmonitor.StandbyPool(client, size=1)
+        for round in xrange(3):
+            domains = ['failover%d.example.com' % round]
+            start = time.time()
+            tunnelmonitor.get_new_tunnel(client, domains)
+            booted = time.time() - start
+
+            pool.maintain()
+            while not pool.standbys:
+                time.sleep(0.1)
+            start = time.time()
+            client.delete_tunnels_by_domains(domains)
+            pool.promote(domains)
+            promoted = time.time() - start
+            print "new tunnel: %6.0f ms   standby: %6.0f ms" % (
+                booted * 1000, promoted * 1000)
+        pool.close()
+    finally:
+        fake.boot_time = boot_time
+
+
+@benchmark
+def bench_metrics(fake, options):
+    """cost of recording request metrics"""
+    client_metrics = metrics.ClientMetrics()
+    rounds = 100000
+    start = time.time()
+    for i in xrange(rounds):
+        client_metrics.observe('GET', 'tunnels', 0.042, 200, 0, 512)
+    per_observe = (time.time() - start) / rounds
+    print "observe(): %.2f usec per call" % (per_observe * 1e6)
+
+    fake.latency, latency = 0, fake.latency
+    try:
+        tunnel_id = _client(fake).create_tunnel({})['id']
+        for label, client_metrics in (("without metrics", False),
+                                      ("with metrics", None)):
+            client = _client(fake, client_metrics=client_metrics)
+            client.get_tunnel(tunnel_id)
+            start = time.time()
+            for i in xrange(options.count):
+                client.get_tunnel(tunnel_id)
+            elapsed = time.time() - start
+            print "get_tunnel %-16s %8.1f usec per call" % (
+                label + ":", elapsed / options.count * 1e6)
+    finally:
+        fake.latency = latency
+
+
+def _parse_options():
+    names = sorted(BENCHMARKS)
+    op = OptionParser(usage="usage: %%prog [options] <benchmark>...\n\n"
+                            "benchmarks: %s" % ", ".join(names))
+    op.add_option("-n", "--count", default=1000, type="int",
+                  help="requests per run [default: %default]")
+    op.add_option("-c", "--concurrency", default="1,2,4,8,16,32",
+                  help="comma-separated concurrency levels"
+                       " [default: %default]")
+    op.add_option("--latency", default=0.02, type="float",
+                  help="simulated server latency in seconds"
+                       " [default: %default]")
+    op.add_option("--jitter", default=0, type="float",
+                  help="up to this many more seconds of random latency")
+    op.add_option("--error-rate", default=0, type="float",
+                  help="fraction of requests the server fails with a 503")
+    op.add_option("--list-size", default=500, type="int",
+                  help="jobs on the server for the list benchmark"
+                       " [default: %default]")
+    op.add_option("--job-duration", default=2, type="float",
+                  help="seconds each job runs in wait_for_jobs"
+                       " [default: %default]")
+    op.add_option("--boot-time", default=1, type="float",
+                  help="seconds each tunnel boots in provision"
+                       " [default: %default]")
+    options, args = op.parse_args()
+    for name in args:
+        if name not in BENCHMARKS:
+            op.error("unknown benchmark: %s" % name)
+    options.concurrency = [int(c) for c in options.concurrency.split(",")]
+    return options, args or names
+
+
+if __name__ == '__main__':
+    options, names = _parse_options()
+    logging.basicConfig(level=logging.ERROR, format="%(message)s")
+    fake = FakeSauce(latency=options.latency, jitter=options.jitter,
+                     error_rate=options.error_rate).start()
+    try:
+        for name in names:
+            print "== %s: %s" % (name, BENCHMARKS[name].__doc__)
+            BENCHMARKS[name](fake, options)
+            sys.stdout.flush()
+    finally:
+        fake.stop()
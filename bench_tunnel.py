@@ -0,0 +1,687 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmarks for sshtunnel against a local fakesshd server, which runs in
+its own process so the numbers here are the tunnel client's alone.
+
+    $ python bench_tunnel.py connect --ports 1,10,30
+    $ python bench_tunnel.py workers --workers 1,2,4
+    $ python bench_tunnel.py window --delay 0.05
+    $ python bench_tunnel.py buffering --sink-rate 4
+    $ python bench_tunnel.py copies --size 32
+    $ python bench_tunnel.py pool --pool-sizes 0,4,16 -c 1,8
+    $ python bench_tunnel.py admission --burst 200
+
+Throughput benchmarks push data from a source process, through fakesshd
+and the tunnel, to a sink process standing in for the local app.
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import struct
+import logging
+import threading
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+from twisted.internet import defer, protocol, reactor, task, threads
+from twisted.conch.ssh import forwarding
+
+import sshtunnel
+import sshworkers
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__[len('bench_'):]] = function
+    return function
+
+
+def _start_sshd(processes=1, delay=0):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fakesshd.py')
+    sshd = subprocess.Popen([sys.executable, path, '--port', '0',
+                             '--processes', str(processes),
+                             '--delay', str(delay)],
+                            stdout=subprocess.PIPE)
+    sshd.port = int(sshd.stdout.readline())
+    return sshd
+
+
+def _free_ports(count):
+    sockets = []
+    for i in xrange(count):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def _rss(pid='self'):
+    """Resident set size of a process in KiB."""
+    for line in open('/proc/%s/status' % pid):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+    return 0
+
+
+def _cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+class _Echo(protocol.Protocol):
+
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+def _listen_local():
+    return reactor.listenTCP(0, protocol.Factory.forProtocol(_Echo),
+                             interface='127.0.0.1')
+
+
+def _connect(sshd, ports, **kwargs):
+    """
+    Open the tunnel for ports; return a Deferred firing with the SSH
+    transports once every forward is accepted.
+    """
+    connected = defer.Deferred()
+    deferreds = sshtunnel.connect_tunnel(
+        'bench', None, 'bench', 'bench', '127.0.0.1', '127.0.0.1', ports,
+        lambda: connected.callback(None), None, lambda: None, False,
+        ssh_port=sshd.port, **kwargs)
+    connected.addCallback(lambda _: defer.gatherResults(deferreds))
+    return connected
+
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _drain(conn, rate=None):
+    # each stream starts with its length, and is acknowledged once read
+    remaining = struct.unpack('>Q', _recv_exactly(conn, 8))[0]
+    buf = bytearray(65536)
+    start, done = time.time(), 0
+    while remaining:
+        count = conn.recv_into(buf, min(len(buf), remaining))
+        if not count:
+            break
+        remaining -= count
+        done += count
+        if rate:
+            time.sleep(max(0, start + float(done) / rate - time.time()))
+    conn.sendall('k')
+    conn.close()
+
+
+def _feed(conn, rate=None):
+    # send as many bytes as asked for, then wait for the peer to close
+    remaining = struct.unpack('>Q', _recv_exactly(conn, 8))[0]
+    chunk = '\0' * 65536
+    while remaining > 0:
+        conn.sendall(remaining >= len(chunk) and chunk or chunk[:remaining])
+        remaining -= len(chunk)
+    _recv_exactly(conn, 1)
+    conn.close()
+
+
+def _serve(server, handler, *args):
+    """
+    Run handler(conn, *args) in a thread for every connection accepted on
+    server, until the process is terminated.
+    """
+    # the reactor's signal handlers came along with the fork; without
+    # this, terminate() interrupts accept() and the child dies noisily
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    while True:
+        try:
+            conn, _ = server.accept()
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        thread = threading.Thread(target=handler, args=(conn,) + args)
+        thread.setDaemon(True)
+        thread.start()
+
+
+def _sink(port_queue, rate=None, handler=_drain):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(128)
+    port_queue.put(server.getsockname()[1])
+    _serve(server, handler, rate)
+
+
+def _start_sink(rate=None, handler=_drain):
+    """
+    Start the sink process, reading each stream at up to rate bytes per
+    second if given; return the port it listens on. With handler=_feed it
+    is a source instead, sending each stream what it asks for.
+    """
+    port_queue = multiprocessing.Queue()
+    sink = multiprocessing.Process(target=_sink,
+                                   args=(port_queue, rate, handler))
+    sink.daemon = True
+    sink.start()
+    return port_queue.get()
+
+
+def _send(port, size):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(struct.pack('>Q', size))
+    chunk = '\0' * 65536
+    while size > 0:
+        sock.sendall(size >= len(chunk) and chunk or chunk[:size])
+        size -= len(chunk)
+    _recv_exactly(sock, 1)
+    sock.close()
+
+
+def _fetch(port, size):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(struct.pack('>Q', size))
+    buf = bytearray(65536)
+    while size > 0:
+        count = sock.recv_into(buf)
+        if not count:
+            break
+        size -= count
+    sock.close()
+
+
+def _source(ports, size, streams, results, function=_send):
+    senders = [threading.Thread(target=function, args=(port, size))
+               for port in ports for i in xrange(streams)]
+    start = time.time()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    results.put(time.time() - start)
+
+
+def _transfer(ports, size, streams, function=_send):
+    """
+    Send `size` bytes over `streams` connections to each of the remote
+    ports from a source process. Return a Deferred firing with the seconds
+    taken for all of it to reach the sink. With function=_fetch the bytes
+    are fetched from a _feed source instead.
+    """
+    results = multiprocessing.Queue()
+    source = multiprocessing.Process(
+        target=_source, args=(ports, size, streams, results, function))
+    source.start()
+    d = threads.deferToThread(results.get)
+    d.addCallback(lambda seconds: (source.join(), seconds)[1])
+    return d
+
+
+def _request(port):
+    """
+    Time one short connection: connect, send a byte, read the echo.
+    Return None if no echo came back.
+    """
+    start = time.time()
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall('x')
+    echo = _recv_exactly(sock, 1)
+    sock.close()
+    return echo and time.time() - start or None
+
+
+def _requester(port, count, concurrency, results):
+    def run(latencies):
+        for i in xrange(count // concurrency):
+            latencies.append(_request(port))
+    lists = [[] for i in xrange(concurrency)]
+    threads = [threading.Thread(target=run, args=(l,)) for l in lists]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = sum(lists, [])
+    results.put((sorted(l for l in latencies if l is not None),
+                 latencies.count(None)))
+
+
+def _requests(port, count, concurrency):
+    """
+    Make count short connections to port, concurrency at a time, from
+    another process. Return a Deferred firing with the sorted latencies
+    and the number of connections that failed.
+    """
+    results = multiprocessing.Queue()
+    requester = multiprocessing.Process(
+        target=_requester, args=(port, count, concurrency, results))
+    requester.start()
+    d = threads.deferToThread(results.get)
+    d.addCallback(lambda latencies: (requester.join(), latencies)[1])
+    return d
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+@defer.inlineCallbacks
+def _disconnect(transports):
+    for transport in transports:
+        transport.loseConnection()
+    # let the server stop listening on the forwarded ports
+    yield _sleep(0.5)
+
+
+@benchmark
+@defer.inlineCallbacks
+def bench_connect(sshd, options):
+    """connect time and memory, multiplexed vs one SSH connection per port"""
+    local = _listen_local()
+    local_port = local.getHost().port
+    # warm up, so the first row doesn't pay for imports and the like
+    transports = yield _connect(sshd, [(local_port, _free_ports(1)[0])])
+    yield _disconnect(transports)
+    print "%-10s %6s %11s %8s %12s %12s" % (
+        "mode", "ports", "connect ms", "cpu ms", "client KiB", "server KiB")
+    for count in options.ports:
+        for multiplex in (True, False):
+            ports = [(local_port, p) for p in _free_ports(count)]
+            rss, server_rss, cpu = _rss(), _rss(sshd.pid), _cpu()
+            start = time.time()
+            transports = yield _connect(sshd, ports, multiplex=multiplex)
+            elapsed = time.time() - start
+            print "%-10s %6d %11.1f %8.1f %12d %12d" % (
+                multiplex and "multiplex" or "per-port", count,
+                elapsed * 1000, (_cpu() - cpu) * 1000, _rss() - rss,
+                _rss(sshd.pid) - server_rss)
+            sys.stdout.flush()
+            yield _disconnect(transports)
+    local.stopListening()
+
+
+@benchmark
+@defer.inlineCallbacks
+def bench_workers(sshd, options):
+    """throughput as forwarding is spread over more worker processes"""
+    sink_port = _start_sink()
+    count = max(options.workers)
+    streams = options.streams
+    print "%8s %6s %8s %10s" % ("workers", "ports", "MB", "MB/s")
+    for workers in options.workers:
+        ports = [(sink_port, p) for p in _free_ports(count)]
+        connected = defer.Deferred()
+        tunnel = sshworkers.ShardedTunnel(
+            workers, 'bench', None, 'bench', 'bench', '127.0.0.1',
+            '127.0.0.1', ports, lambda: connected.callback(None), None,
+            lambda: None, False, ssh_port=sshd.port).start()
+        yield connected
+        seconds = yield _transfer([p for _, p in ports], options.size,
+                                  streams)
+        total = options.size * streams * count / 1e6
+        print "%8d %6d %8.1f %10.1f" % (workers, count, total,
+                                        total / seconds)
+        sys.stdout.flush()
+        tunnel.stop()
+        yield _sleep(0.5)
+
+
+KB = 1024
+MB = 1024 * KB
+
+WINDOW_SETTINGS = (
+    ("default (128KB/32KB)", sshtunnel.ChannelSettings()),
+    ("1MB window", sshtunnel.ChannelSettings(1 * MB)),
+    ("4MB window", sshtunnel.ChannelSettings(4 * MB)),
+    ("4MB window, 128KB pkt", sshtunnel.ChannelSettings(4 * MB, 128 * KB)),
+    ("auto up to 8MB", sshtunnel.ChannelSettings(max_window=8 * MB)),
+)
+
+
+@benchmark
+@defer.inlineCallbacks
+def bench_window(sshd, options):
+    """single stream throughput by channel window and packet size"""
+    # a server of our own, so we can make the link slow
+    sshd = _start_sshd(delay=options.delay)
+    sink_port = _start_sink()
+    print "RTT added by fakesshd: %.0f ms" % (options.delay * 1000)
+    print "%-24s %8s %10s" % ("settings", "MB", "MB/s")
+    try:
+        for label, settings in WINDOW_SETTINGS:
+            ports = [(sink_port, _free_ports(1)[0])]
+            transports = yield _connect(sshd, ports, settings=settings)
+            seconds = yield _transfer([ports[0][1]], options.size, 1)
+            print "%-24s %8.1f %10.1f" % (label, options.size / 1e6,
+                                          options.size / 1e6 / seconds)
+            sys.stdout.flush()
+            yield _disconnect(transports)
+    finally:
+        sshd.terminate()
+
+
+BUFFER_SETTINGS = (
+    ("unbounded", sshtunnel.ChannelSettings(high_water=1 << 40)),
+    ("256KB/64KB marks", sshtunnel.ChannelSettings()),
+    ("64KB/16KB marks", sshtunnel.ChannelSettings(high_water=64 * KB,
+                                                  low_water=16 * KB)),
+    ("1MB total cap", sshtunnel.ChannelSettings(max_buffered=1 * MB)),
+)
+
+
+@benchmark
+@defer.inlineCallbacks
+def bench_buffering(sshd, options):
+    """buffered bytes and memory with a local app reading slowly"""
+    rate = options.sink_rate * 1e6
+    sink_port = _start_sink(rate)
+    print "sink reads each stream at %.1f MB/s" % options.sink_rate
+    print "%-18s %8s %10s %14s %12s" % ("settings", "MB", "MB/s",
+                                          "peak buf KiB", "rss KiB")
+    for label, settings in BUFFER_SETTINGS:
+        ports = [(sink_port, _free_ports(1)[0])]
+        flow = sshtunnel.FlowControl(settings)
+        transports = yield _connect(sshd, ports, settings=settings,
+                                    flow_control=flow)
+        rss = [_rss()]
+        sampler = task.LoopingCall(lambda: rss.append(_rss()))
+        sampler.start(0.1)
+        seconds = yield _transfer([ports[0][1]], options.size,
+                                  options.streams)
+        sampler.stop()
+        total = options.size * options.streams / 1e6
+        print "%-18s %8.1f %10.1f %14d %12d" % (
+            label, total, total / seconds, flow.peak / 1024,
+            max(rss) - rss[0])
+        sys.stdout.flush()
+        yield _disconnect(transports)
+
+
+def _delay_local_connects(delay):
+    """
+    Make sshtunnel's local connections take delay seconds longer, as if
+    the local host were on another machine; return a function undoing it.
+    """
+    connect_local = sshtunnel._connect_local
+
+    def delayed(*args):
+        return task.deferLater(reactor, delay, connect_local, *args)
+    sshtunnel._connect_local = delayed
+    return lambda: setattr(sshtunnel, '_connect_local', connect_local)
+
+
+@benchmark
+@defer.inlineCallbacks
+def bench_pool(sshd, options):
+    """short connection latency with and without a local connection pool"""
+    local = _listen_local()
+    local_port = local.getHost().port
+    undo = _delay_local_connects(options.connect_delay)
+    print "local connects take %.0f ms more" % (options.connect_delay * 1000)
+    print "%9s %11s %9s %9s %6s %7s" % ("pool size", "concurrency",
+                                        "p50 ms", "p99 ms", "hits", "misses")
+    try:
+        for size in options.pool_sizes:
+            for concurrency in options.concurrency:
+                settings = sshtunnel.ChannelSettings(pool_size=size)
+                pool = size and sshtunnel.LocalConnectionPool(settings) or None
+                ports = [(local_port, _free_ports(1)[0])]
+                transports = yield _connect(sshd, ports, settings=settings,
+                                            pool=pool)
+                # let the pool fill
+                yield _sleep(0.2)
+                latencies, failed = yield _requests(ports[0][1],
+                                                    options.count,
+                                                    concurrency)
+                stats = pool and pool.stats() or dict(hits=0, misses=0)
+                print "%9d %11d %9.2f %9.2f %6d %7d" % (
+                    size, concurrency, _percentile(latencies, 0.5) * 1000,
+                    _percentile(latencies, 0.99) * 1000, stats['hits'],
+                    stats['misses'])
+                sys.stdout.flush()
+                yield _disconnect(transports)
+                if pool:
+                    pool.close()
+    finally:
+        undo()
+        local.stopListening()
+
+
+def _slow_echo(port_queue, delay, count, peak):
+    """
+    Echo each connection's byte after delay, keeping count of the
+    connections open and the most open at once.
+    """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1024)
+    port_queue.put(server.getsockname()[1])
+
+    def serve(conn):
+        count.acquire()
+        count.value += 1
+        peak.value = max(peak.value, count.value)
+        count.release()
+        data = conn.recv(1)
+        time.sleep(delay)
+        conn.sendall(data)
+        while conn.recv(1024):
+            pass
+        conn.close()
+        count.acquire()
+        count.value -= 1
+        count.release()
+    _serve(server, serve)
+
+
+ADMISSION_SETTINGS = (
+    ("no limit", sshtunnel.ChannelSettings()),
+    ("8 at once, 256 queued", sshtunnel.ChannelSettings(max_channels=8,
+                                                        max_queued=256)),
+    ("8 at once, 32 queued", sshtunnel.ChannelSettings(max_channels=8,
+                                                       max_queued=32)),
+    ("8 at once, 1s wait", sshtunnel.ChannelSettings(max_channels=8,
+                                                     max_queued=256,
+                                                     queue_timeout=1)),
+)
+
+
+@benchmark
+@defer.inlineCallbacks
+def bench_admission(sshd, options):
+    """a burst of connections to a slow local server, by admission limit"""
+    port_queue = multiprocessing.Queue()
+    count = multiprocessing.Value('i', 0)
+    peak = multiprocessing.Value('i', 0)
+    server = multiprocessing.Process(
+        target=_slow_echo,
+        args=(port_queue, options.local_delay, count, peak))
+    server.daemon = True
+    server.start()
+    local_port = port_queue.get()
+    print "%d connections at once, local server answers in %.0f ms" % (
+        options.burst, options.local_delay * 1000)
+    print "%-22s %10s %9s %9s %7s %9s" % ("settings", "local peak", "p50 ms",
+                                         "p99 ms", "failed", "max wait")
+    try:
+        for label, settings in ADMISSION_SETTINGS:
+            # the last row's connections may take a moment to close
+            for i in xrange(50):
+                if not count.value:
+                    break
+                yield _sleep(0.1)
+            peak.value = count.value
+            admission = (settings.max_channels and
+                         sshtunnel.AdmissionControl(settings) or None)
+            ports = [(local_port, _free_ports(1)[0])]
+            transports = yield _connect(sshd, ports, settings=settings,
+                                        admission=admission)
+            latencies, failed = yield _requests(ports[0][1], options.burst,
+                                                options.burst)
+            stats = admission and admission.stats() or dict(max_wait=0)
+            print "%-22s %10d %9.1f %9.1f %7d %9.1f" % (
+                label, peak.value, _percentile(latencies, 0.5) * 1000,
+                _percentile(latencies, 0.99) * 1000, failed,
+                stats['max_wait'] * 1000)
+            sys.stdout.flush()
+            yield _disconnect(transports)
+    finally:
+        server.terminate()
+
+
+class _ConchChannel(forwarding.SSHConnectForwardingChannel):
+    """Conch's own forwarding channel, taking TunnelForwardingChannel's
+    arguments."""
+
+    def __init__(self, hostport, max_window=None, flow_control=None,
+                 pool=None, admission=None, connect_timeout=None, *args,
+                 **kw):
+        forwarding.SSHConnectForwardingChannel.__init__(self, hostport,
+                                                        *args, **kw)
+
+
+@benchmark
+@defer.inlineCallbacks
+def bench_copies(sshd, options):
+    """throughput and CPU per MB, TunnelForwardingChannel vs Conch's"""
+    sink_port = _start_sink()
+    feed_port = _start_sink(handler=_feed)
+    print "%-10s %-12s %8s %10s %12s" % ("channel", "direction", "MB",
+                                          "MB/s", "cpu ms/MB")
+    directions = (("to local", sink_port, _send),
+                  ("from local", feed_port, _fetch))
+    for label, channel_class in (("conch", _ConchChannel),
+                                 ("tunnel", None)):
+        sshtunnel.TunnelConnection.forwarding_channel = channel_class
+        try:
+            for direction, local_port, function in directions:
+                ports = [(local_port, _free_ports(1)[0])]
+                transports = yield _connect(sshd, ports)
+                cpu = _cpu()
+                seconds = yield _transfer([ports[0][1]], options.size,
+                                          options.streams, function)
+                cpu = _cpu() - cpu
+                total = options.size * options.streams / 1e6
+                print "%-10s %-12s %8.1f %10.1f %12.1f" % (
+                    label, direction, total, total / seconds,
+                    cpu * 1000 / total)
+                sys.stdout.flush()
+                yield _disconnect(transports)
+        finally:
+            sshtunnel.TunnelConnection.forwarding_channel = None
+
+
+def _parse_options():
+    names = sorted(BENCHMARKS)
+    op = OptionParser(usage="usage: %%prog [options] <benchmark>...\n\n"
+                            "benchmarks: %s" % ", ".join(names))
+    op.add_option("--ports", default="1,5,10,30",
+                  help="comma-separated numbers of forwarded ports"
+                       " [default: %default]")
+    op.add_option("--workers", default="1,2,4",
+                  help="comma-separated numbers of worker processes"
+                       " [default: %default]")
+    op.add_option("--size", default=8, type="float",
+                  help="MB sent over each stream [default: %default]")
+    op.add_option("--streams", default=2, type="int",
+                  help="concurrent streams per forwarded port"
+                       " [default: %default]")
+    op.add_option("--delay", default=0.05, type="float",
+                  help="round trip time in seconds fakesshd adds in the"
+                       " window benchmark [default: %default]")
+    op.add_option("--sink-rate", default=4, type="float",
+                  help="MB/s each stream is read at in the buffering"
+                       " benchmark [default: %default]")
+    op.add_option("--pool-sizes", default="0,4,16",
+                  help="comma-separated local connection pool sizes"
+                       " [default: %default]")
+    op.add_option("--connect-delay", default=0.01, type="float",
+                  help="seconds added to each local connect in the pool"
+                       " benchmark [default: %default]")
+    op.add_option("-n", "--count", default=400, type="int",
+                  help="connections made in the pool benchmark"
+                       " [default: %default]")
+    op.add_option("-c", "--concurrency", default="1,8",
+                  help="comma-separated numbers of connections made at"
+                       " once in the pool benchmark [default: %default]")
+    op.add_option("--burst", default=200, type="int",
+                  help="connections made at once in the admission benchmark"
+                       " [default: %default]")
+    op.add_option("--local-delay", default=0.05, type="float",
+                  help="seconds the local server takes to answer in the"
+                       " admission benchmark [default: %default]")
+    op.add_option("--sshd-processes", default=multiprocessing.cpu_count(),
+                  type="int",
+                  help="fakesshd processes [default: %default]")
+    options, args = op.parse_args()
+    for name in args:
+        if name not in BENCHMARKS:
+            op.error("unknown benchmark: %s" % name)
+    options.ports = [int(p) for p in options.ports.split(",")]
+    options.workers = [int(w) for w in options.workers.split(",")]
+    options.pool_sizes = [int(p) for p in options.pool_sizes.split(",")]
+    options.concurrency = [int(c) for c in options.concurrency.split(",")]
+    options.size = int(options.size * 1e6)
+    return options, args or names
+
+
+if __name__ == '__main__':
+    options, names = _parse_options()
+    logging.basicConfig(level=logging.ERROR, format="%(message)s")
+    sshd = _start_sshd(options.sshd_processes)
+
+    @defer.inlineCallbacks
+    def run(reactor):
+        try:
+            for name in names:
+                print "== %s: %s" % (name, BENCHMARKS[name].__doc__)
+                yield BENCHMARKS[name](sshd, options)
+        finally:
+            sshd.terminate()
+
+    task.react(run)
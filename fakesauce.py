@@ -0,0 +1,339 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Local in-memory stand-in for the SauceREST endpoints SauceClient uses:
+
+    /rest/<account>/tunnels|jobs|scripts[/<id>[/<attachment>]]
+
+Latency, failures and the lifecycle of tunnels (booting -> running ->
+terminated) and jobs (in progress -> complete) can be simulated. Handy for
+benchmarks and for trying the tools without saucelabs.com:
+
+    $ python fakesauce.py --port 8080
+
+and point a client at it with base_url="http://localhost:8080".
+"""
+
+import cgi
+import md5
+import re
+import random
+import time
+import uuid
+import zlib
+import logging
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+
+import simplejson
+
+logger = logging.getLogger(__name__)
+
+TYPES = ('tunnels', 'jobs', 'scripts')
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # one segment per reply; otherwise Nagle and delayed ACKs add ~40ms
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _reply(self, code, doc):
+        headers = []
+        if isinstance(doc, str):
+            # attachments go out as they were uploaded, honouring
+            # "Range: bytes=<start>-" so clients can resume
+            body, content_type = doc, 'application/octet-stream'
+            match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+            if code == 200 and match:
+                start = int(match.group(1))
+                if start >= len(doc):
+                    code, body = 416, ''
+                else:
+                    code, body = 206, doc[start:]
+                    headers.append(('Content-Range', 'bytes %d-%d/%d'
+                                    % (start, len(doc) - 1, len(doc))))
+        else:
+            body, content_type = simplejson.dumps(doc), 'application/json'
+        etag = '"%s"' % md5.new(body).hexdigest()
+        if code == 200 and self.command == 'GET' and \
+                self.headers.get('If-None-Match') == etag:
+            code, body = 304, ''
+        self.send_response(code)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _handle(self, method):
+        fake = self.server.fake
+        body = self._read_body()
+        fake.lock.acquire()
+        fake.requests += 1
+        fake.lock.release()
+        if fake.latency or fake.jitter:
+            time.sleep(fake.latency + random.uniform(0, fake.jitter))
+        if fake.error_rate and random.random() < fake.error_rate:
+            return self._reply(fake.error_status, {'error': 'Injected error'})
+        path, _, query = self.path.partition('?')
+        path = path.strip('/').split('/')
+        if len(path) < 3 or path[0] != 'rest' or path[2] not in TYPES:
+            return self._reply(404, {'error': 'Not found'})
+        code, doc = fake.handle(method, path[2], path[3:], body,
+                                cgi.parse_qs(query))
+        self._reply(code, doc)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # the default backlog of 5 drops bursts of new connections, which
+    # then show up as 1s SYN retransmits in the latencies
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on keep-alive connections is business as usual
+        try:
+            logger.debug("Error handling request from %s", client_address,
+                         exc_info=True)
+        except:
+            # a handler thread outliving the interpreter, whose module
+            # globals are None by now
+            pass
+
+    def shutdown_request(self, request):
+        try:
+            HTTPServer.shutdown_request(self, request)
+        except:
+            # as in handle_error()
+            pass
+
+
+class FakeSauce:
+    """
+    In-memory SauceREST server running in a background thread.
+
+    Each request takes latency seconds plus up to jitter more, and fails
+    with error_status at error_rate (0 to 1). Tunnels report 'booting' for
+    boot_time seconds, then 'running', then 'terminated' once lifetime
+    seconds have passed, if given. If job_duration is given, jobs are 'in
+    progress' for that long and then 'complete', or 'error' at
+    job_error_rate. Attributes can be changed while the server runs.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, jitter=0,
+                 error_rate=0, error_status=503, boot_time=0, lifetime=None,
+                 job_duration=None, job_error_rate=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.boot_time = boot_time
+        self.lifetime = lifetime
+        self.job_duration = job_duration
+        self.job_error_rate = job_error_rate
+        self.requests = 0
+        self.docs = dict((type, {}) for type in TYPES)
+        self.attachments = {}
+        self.lock = threading.Lock()
+        self.server = _Server((host, port), _Handler)
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def new_doc(self, type, body):
+        doc_id = uuid.uuid4().hex
+        doc = dict(body, _id=doc_id, id=doc_id, CreationTime=time.time())
+        if type == 'tunnels':
+            doc.setdefault('Status', self.boot_time and 'booting' or 'running')
+            doc.setdefault('Host', '127.0.0.1')
+        elif type == 'jobs':
+            if self.job_duration is not None:
+                doc.setdefault('Status', 'in progress')
+            doc.setdefault('Status', 'new')
+        return doc
+
+    def advance(self, type, doc, now):
+        """Move doc along its lifecycle according to its age."""
+        age = now - doc['CreationTime']
+        if type == 'tunnels' and doc['Status'] in ('booting', 'running'):
+            if age < self.boot_time:
+                doc['Status'] = 'booting'
+            elif self.lifetime is not None and \
+                    age >= self.boot_time + self.lifetime:
+                doc['Status'] = 'terminated'
+            else:
+                doc['Status'] = 'running'
+        elif type == 'jobs' and doc['Status'] == 'in progress' and \
+                self.job_duration is not None and age >= self.job_duration:
+            if random.random() < self.job_error_rate:
+                doc['Status'] = 'error'
+            else:
+                doc['Status'] = 'complete'
+        return doc
+
+    def handle(self, method, type, parts, body, query={}):
+        """Return (status code, JSON document) for a REST call."""
+        docs = self.docs[type]
+        self.lock.acquire()
+        try:
+            if method == 'GET' and not parts:
+                query = dict(query)
+                skip = int(query.pop('skip', [0])[0])
+                limit = int(query.pop('limit', [0])[0]) or None
+                since = float(query.pop('since', [0])[0])
+                until = float(query.pop('until', [0])[0]) or None
+                now = time.time()
+                listing = sorted((self.advance(type, d, now)
+                                  for d in docs.values()),
+                                 key=lambda d: d.get('CreationTime'))
+                if since or until:
+                    listing = [d for d in listing
+                               if since <= d['CreationTime'] and
+                               (until is None or d['CreationTime'] < until)]
+                # filters like ?batch=a&batch=b match the capitalised field
+                for key, values in query.iteritems():
+                    field = key.capitalize()
+                    listing = [d for d in listing if d.get(field) in values]
+                return 200, listing[skip:limit and skip + limit]
+            if method == 'POST' and not parts:
+                try:
+                    doc = self.new_doc(type, simplejson.loads(body or '{}'))
+                except ValueError:
+                    return 400, {'error': 'Invalid JSON'}
+                docs[doc['id']] = doc
+                return 200, doc
+            if not parts or parts[0] not in docs:
+                return 404, {'error': 'Not found'}
+            doc = self.advance(type, docs[parts[0]], time.time())
+            if method == 'GET' and len(parts) == 1:
+                return 200, doc
+            if method == 'GET':
+                return 200, self.attachments.get(tuple(parts), '')
+            if method == 'PUT' and len(parts) == 1:
+                try:
+                    doc.update(simplejson.loads(body or '{}'))
+                except ValueError:
+                    return 400, {'error': 'Invalid JSON'}
+                doc['_id'] = doc['id'] = parts[0]
+                return 200, doc
+            if method == 'PUT' and type == 'scripts' and len(parts) == 2:
+                self.attachments[tuple(parts)] = body
+                return 200, {'ok': True}
+            if method == 'DELETE':
+                if type == 'tunnels':
+                    doc['Status'] = 'terminated'
+                else:
+                    del docs[parts[0]]
+                return 200, {'ok': True}
+            return 405, {'error': 'Method not allowed'}
+        finally:
+            self.lock.release()
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage="usage: %prog [options]")
+    op.add_option("--host", default="127.0.0.1",
+                  help="address to listen on [default: %default]")
+    op.add_option("-p", "--port", default=8080, type="int",
+                  help="port to listen on [default: %default]")
+    op.add_option("--latency", default=0, type="float",
+                  help="seconds to wait before answering each request")
+    op.add_option("--jitter", default=0, type="float",
+                  help="up to this many more seconds of random latency")
+    op.add_option("--error-rate", default=0, type="float",
+                  help="fraction of requests to fail with a 503")
+    op.add_option("--boot-time", default=0, type="float",
+                  help="seconds tunnels spend booting")
+    op.add_option("--lifetime", type="float",
+                  help="seconds tunnels run before being terminated")
+    op.add_option("--job-duration", type="float",
+                  help="seconds jobs run before completing")
+    options, args = op.parse_args()
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+
+    fake = FakeSauce(options.host, options.port, options.latency,
+                     options.jitter, options.error_rate,
+                     boot_time=options.boot_time, lifetime=options.lifetime,
+                     job_duration=options.job_duration)
+    print "Serving SauceREST stand-in on %s" % fake.base_url
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
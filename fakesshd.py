@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Local SSH server standing in for a Sauce tunnel machine.
+
+Any user name and password are accepted. tcpip-forward requests are
+honoured like sshd does for ssh -R: the server listens on the requested
+port and sends each connection back over a forwarded-tcpip channel.
+Handy for benchmarks and for trying sshtunnel without saucelabs.com:
+
+    $ python fakesshd.py --port 2222
+
+The port actually listened on is printed once the server is up. With
+--processes the listening socket is shared by that many processes, so
+encryption on the server side can use more than one core. --delay holds
+back everything the server receives, adding that much to the round trip
+time as if the tunnel host were far away.
+"""
+
+import sys
+import time
+import socket
+import struct
+import logging
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+from zope.interface import implementer
+from twisted.cred import checkers, credentials, portal
+from twisted.internet import defer, reactor
+from twisted.conch import avatar
+from twisted.conch.ssh import channel, factory, forwarding, keys, transport
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+logger = logging.getLogger(__name__)
+
+
+@implementer(checkers.ICredentialsChecker)
+class _AnyPassword:
+
+    credentialInterfaces = (credentials.IUsernamePassword,)
+
+    def requestAvatarId(self, creds):
+        return defer.succeed(creds.username)
+
+
+class _Session(channel.SSHChannel):
+    """Session channel that ignores whatever it is sent."""
+
+    name = 'session'
+
+    def request_shell(self, data):
+        return 1
+
+
+class _ForwardedChannel(forwarding.SSHListenServerForwardingChannel):
+
+    def openFailed(self, reason):
+        # Conch would go on to close the channel it never opened
+        self.client.channel = None
+        forwarding.SSHListenServerForwardingChannel.openFailed(self, reason)
+
+
+class _User(avatar.ConchUser):
+
+    def __init__(self, fake):
+        avatar.ConchUser.__init__(self)
+        self.fake = fake
+        self.listeners = {}
+        self.channelLookup['session'] = _Session
+
+    def global_tcpip_forward(self, data):
+        host, port = forwarding.unpackGlobal_tcpip_forward(data)
+        try:
+            listener = reactor.listenTCP(
+                port,
+                forwarding.SSHListenForwardingFactory(
+                    self.conn, (host, port), _ForwardedChannel),
+                interface=self.fake.interface)
+        except Exception, e:
+            logger.warning("Could not forward port %s: %s", port, e)
+            return 0
+        self.listeners[(host, port)] = listener
+        if port == 0:
+            return 1, struct.pack('>L', listener.getHost().port)
+        return 1
+
+    def global_cancel_tcpip_forward(self, data):
+        listener = self.listeners.pop(
+            forwarding.unpackGlobal_tcpip_forward(data), None)
+        if listener is None:
+            return 0
+        listener.stopListening()
+        return 1
+
+    def logout(self):
+        for listener in self.listeners.values():
+            listener.stopListening()
+        self.listeners.clear()
+
+
+class _DelayedTransport(transport.SSHServerTransport):
+    """Server transport that handles incoming data factory.delay late."""
+
+    def connectionMade(self):
+        transport.SSHServerTransport.connectionMade(self)
+        self.delayed = []
+        self.delayed_call = None
+
+    def dataReceived(self, data):
+        if not self.factory.delay:
+            return transport.SSHServerTransport.dataReceived(self, data)
+        self.delayed.append((time.time() + self.factory.delay, data))
+        if self.delayed_call is None:
+            self._schedule()
+
+    def _schedule(self):
+        due = self.delayed[0][0]
+        self.delayed_call = reactor.callLater(max(0, due - time.time()),
+                                              self._release)
+
+    def _release(self):
+        self.delayed_call = None
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            due, data = self.delayed.pop(0)
+            transport.SSHServerTransport.dataReceived(self, data)
+        if self.delayed:
+            self._schedule()
+
+    def connectionLost(self, reason):
+        if self.delayed_call is not None:
+            self.delayed_call.cancel()
+        transport.SSHServerTransport.connectionLost(self, reason)
+
+
+@implementer(portal.IRealm)
+class _Realm:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def requestAvatar(self, avatar_id, mind, *interfaces):
+        user = _User(self.fake)
+        return interfaces[0], user, user.logout
+
+
+class FakeSSHD:
+    """
+    SSH server in the running reactor. Forwarded ports are listened on at
+    `interface`, whatever address the client asks for.
+    """
+
+    def __init__(self, port=0, interface='127.0.0.1', key_size=2048,
+                 delay=0):
+        self.port = port
+        self.interface = interface
+        key = keys.Key(rsa.generate_private_key(65537, key_size,
+                                                default_backend()))
+        self.factory = factory.SSHFactory()
+        self.factory.protocol = _DelayedTransport
+        self.factory.delay = delay
+        self.factory.portal = portal.Portal(_Realm(self), [_AnyPassword()])
+        self.factory.publicKeys = {'ssh-rsa': key.public()}
+        self.factory.privateKeys = {'ssh-rsa': key}
+        self.listener = None
+
+    def start(self, fileno=None):
+        """Listen on self.port, or on the listening socket fileno."""
+        if fileno is None:
+            self.listener = reactor.listenTCP(self.port, self.factory,
+                                              interface=self.interface)
+        else:
+            self.listener = reactor.adoptStreamPort(fileno, socket.AF_INET,
+                                                    self.factory)
+        self.port = self.listener.getHost().port
+        return self
+
+    def stop(self):
+        return self.listener.stopListening()
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage="usage: %prog [options]")
+    op.add_option("--host", default="127.0.0.1",
+                  help="address to listen on [default: %default]")
+    op.add_option("-p", "--port", default=2222, type="int",
+                  help="port to listen on, 0 for any [default: %default]")
+    op.add_option("--processes", default=1, type="int",
+                  help="number of server processes [default: %default]")
+    op.add_option("--delay", default=0, type="float",
+                  help="seconds to hold back incoming data [default: none]")
+    op.add_option("--fd", type="int",
+                  help=SUPPRESS_HELP)
+    options, args = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    fake = FakeSSHD(options.port, options.host, delay=options.delay)
+    if options.fd is not None:
+        fake.start(options.fd)
+    elif options.processes > 1:
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((options.host, options.port))
+        sock.listen(128)
+        sock.setblocking(False)
+        # fresh processes rather than forks, so each gets its own reactor
+        children = [subprocess.Popen([sys.executable, __file__,
+                                      '--fd', str(sock.fileno()),
+                                      '--delay', str(options.delay)])
+                    for i in xrange(options.processes - 1)]
+        reactor.addSystemEventTrigger(
+            "before", "shutdown",
+            lambda: [child.terminate() for child in children])
+        fake.start(sock.fileno())
+    else:
+        fake.start()
+    print fake.port
+    sys.stdout.flush()
+    reactor.run()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Per-endpoint request metrics for SauceClient, plus timings of named events
+such as a tunnel becoming ready.
+
+    print sauce_client.metrics.prometheus()
+"""
+
+import bisect
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets. The long
+# ones are for events like tunnels booting.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600)
+
+METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+RESOURCES = ('tunnels', 'jobs', 'scripts')
+
+
+class _Series(object):
+
+    __slots__ = ('count', 'total', 'buckets', 'sent', 'received', 'errors',
+                 'statuses')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.statuses = {}
+
+
+class ClientMetrics:
+    """
+    Latency histograms plus byte, status and error counters for each
+    (method, resource) pair. Methods and resources outside METHODS and
+    RESOURCES are counted as 'other', so memory use stays fixed.
+
+    Events get a latency histogram each, keyed by their name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+        self.events = {}
+        for method in METHODS + ('other',):
+            for resource in RESOURCES + ('other',):
+                self.series[(method, resource)] = _Series()
+
+    def observe(self, method, resource, seconds, status=None, sent=0,
+                received=0):
+        """
+        Record one request. status is the HTTP status, or None if the
+        request failed without a response.
+        """
+        series = self.series.get((method, resource))
+        if series is None:
+            if method not in METHODS:
+                method = 'other'
+            if resource not in RESOURCES:
+                resource = 'other'
+            series = self.series[(method, resource)]
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        self.lock.acquire()
+        try:
+            series.count += 1
+            series.total += seconds
+            series.buckets[bucket] += 1
+            series.sent += sent
+            series.received += received
+            if status is None:
+                series.errors += 1
+            else:
+                series.statuses[status] = series.statuses.get(status, 0) + 1
+        finally:
+            self.lock.release()
+
+    def observe_event(self, name, seconds):
+        """Record that event `name` took `seconds`."""
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        self.lock.acquire()
+        try:
+            series = self.events.get(name)
+            if series is None:
+                series = self.events[name] = _Series()
+            series.count += 1
+            series.total += seconds
+            series.buckets[bucket] += 1
+        finally:
+            self.lock.release()
+
+    def _histogram(self, series):
+        cumulative = []
+        running = 0
+        for count in series.buckets:
+            running += count
+            cumulative.append(running)
+        return zip(LATENCY_BUCKETS + ('+Inf',), cumulative)
+
+    def event_snapshot(self):
+        """Return the count, total seconds and histogram of each event."""
+        self.lock.acquire()
+        try:
+            return dict((name, dict(count=series.count, seconds=series.total,
+                                    buckets=self._histogram(series)))
+                        for name, series in self.events.iteritems())
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """Return the metrics of every endpoint used so far as a dict."""
+        self.lock.acquire()
+        try:
+            result = {}
+            for (method, resource), series in self.series.iteritems():
+                if not series.count:
+                    continue
+                result["%s %s" % (method, resource)] = dict(
+                    count=series.count,
+                    seconds=series.total,
+                    buckets=self._histogram(series),
+                    bytes_sent=series.sent,
+                    bytes_received=series.received,
+                    errors=series.errors,
+                    statuses=dict(series.statuses))
+            return result
+        finally:
+            self.lock.release()
+
+    def prometheus(self, prefix='saucerest'):
+        """Return the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        rows = []
+        for key in sorted(snapshot):
+            method, resource = key.split(" ")
+            rows.append(('method="%s",resource="%s"' % (method, resource),
+                         snapshot[key]))
+
+        lines = ["# HELP %s_request_seconds REST request latency." % prefix,
+                 "# TYPE %s_request_seconds histogram" % prefix]
+        for labels, data in rows:
+            for bound, count in data['buckets']:
+                lines.append('%s_request_seconds_bucket{%s,le="%s"} %d'
+                             % (prefix, labels, bound, count))
+            lines.append("%s_request_seconds_sum{%s} %f"
+                         % (prefix, labels, data['seconds']))
+            lines.append("%s_request_seconds_count{%s} %d"
+                         % (prefix, labels, data['count']))
+
+        lines += ["# HELP %s_request_bytes_total Bytes sent and received."
+                  % prefix,
+                  "# TYPE %s_request_bytes_total counter" % prefix]
+        for labels, data in rows:
+            lines.append('%s_request_bytes_total{%s,direction="sent"} %d'
+                         % (prefix, labels, data['bytes_sent']))
+            lines.append('%s_request_bytes_total{%s,direction="received"} %d'
+                         % (prefix, labels, data['bytes_received']))
+
+        lines += ["# HELP %s_responses_total Responses by HTTP status."
+                  % prefix,
+                  "# TYPE %s_responses_total counter" % prefix]
+        for labels, data in rows:
+            for status, count in sorted(data['statuses'].items()):
+                lines.append('%s_responses_total{%s,status="%s"} %d'
+                             % (prefix, labels, status, count))
+
+        lines += ["# HELP %s_errors_total Requests that got no response."
+                  % prefix,
+                  "# TYPE %s_errors_total counter" % prefix]
+        for labels, data in rows:
+            lines.append("%s_errors_total{%s} %d"
+                         % (prefix, labels, data['errors']))
+
+        events = self.event_snapshot()
+        if events:
+            lines += ["# HELP %s_event_seconds Time taken by events." % prefix,
+                      "# TYPE %s_event_seconds histogram" % prefix]
+        for name in sorted(events):
+            data = events[name]
+            labels = 'event="%s"' % name
+            for bound, count in data['buckets']:
+                lines.append('%s_event_seconds_bucket{%s,le="%s"} %d'
+                             % (prefix, labels, bound, count))
+            lines.append("%s_event_seconds_sum{%s} %f"
+                         % (prefix, labels, data['seconds']))
+            lines.append("%s_event_seconds_count{%s} %d"
+                         % (prefix, labels, data['count']))
+        return "\n".join(lines) + "\n"
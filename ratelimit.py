@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Token-bucket rate limiting shared by every process on a machine.
+
+The bucket lives in a small memory-mapped file guarded by flock(), so all
+the tunnel.py processes pointing at the same file draw from one budget:
+
+    limiter = SharedRateLimiter(default_path(), rate=5, burst=10)
+    sauce_client = saucerest.SauceClient(..., rate_limiter=limiter)
+"""
+
+import os
+import mmap
+import time
+import errno
+import fcntl
+import struct
+import tempfile
+import threading
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = {HIGH: 'high', NORMAL: 'normal', LOW: 'low'}
+
+_STATE = struct.Struct('dd')    # tokens, time of last update
+
+# Longest single sleep while waiting, so waiters notice tokens that other
+# processes left unused
+MAX_SLEEP = 0.5
+
+
+def default_path():
+    """
+    Per-user path for the bucket: under $XDG_RUNTIME_DIR if set, else in
+    the temp directory with the uid in its name, so users on a shared
+    machine neither collide nor draw on each other's budget.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'saucerest-ratelimit')
+    return os.path.join(tempfile.gettempdir(),
+                        'saucerest-ratelimit-%d' % os.getuid())
+
+
+class SharedRateLimiter:
+    """
+    Allows `rate` requests per second on average and bursts of `burst`,
+    across every process using the same path. Lower priorities leave a
+    reserve of tokens untouched, so when the bucket runs low they wait and
+    HIGH priority requests still get through.
+
+    Every process should use the same rate and burst for a given path.
+    """
+
+    def __init__(self, path, rate=5, burst=10, reserves=(0, 0.25, 0.5)):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = float(burst)
+        # fractions of the bucket each priority must leave for the others
+        self.reserves = [fraction * (self.burst - 1) for fraction in reserves]
+        self.lock = threading.Lock()
+        self.waits = dict((p, [0, 0.0, 0.0]) for p in PRIORITY_NAMES)
+
+        # never follow a link or use a file someone else planted there
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+        if os.fstat(fd).st_uid != os.getuid():
+            os.close(fd)
+            raise OSError(errno.EPERM, "Owned by another user", path)
+        self.file = os.fdopen(fd, 'r+b')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < _STATE.size:
+                self.file.write(_STATE.pack(self.burst, time.time()))
+                self.file.flush()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(fd, _STATE.size)
+
+    def _take(self, priority):
+        """Take a token if allowed; otherwise return seconds to wait."""
+        fd = self.file.fileno()
+        # flock() only excludes other processes; threads need the lock too
+        self.lock.acquire()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            tokens, last = _STATE.unpack_from(self.map)
+            now = time.time()
+            tokens = min(self.burst, tokens + max(0, now - last) * self.rate)
+            floor = self.reserves[priority]
+            if tokens - 1 >= floor:
+                _STATE.pack_into(self.map, 0, tokens - 1, now)
+                return 0
+            _STATE.pack_into(self.map, 0, tokens, now)
+            return (floor + 1 - tokens) / self.rate
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            self.lock.release()
+
+    def acquire(self, priority=NORMAL):
+        """Block until a request may be sent; return seconds waited."""
+        start = time.time()
+        while True:
+            wait = self._take(priority)
+            if not wait:
+                break
+            time.sleep(min(wait, MAX_SLEEP))
+        waited = time.time() - start
+        self.lock.acquire()
+        try:
+            counters = self.waits[priority]
+            counters[0] += 1
+            counters[1] += waited
+            counters[2] = max(counters[2], waited)
+        finally:
+            self.lock.release()
+        return waited
+
+    def stats(self):
+        """Requests, total and longest wait in seconds, per priority."""
+        return dict((PRIORITY_NAMES[p], dict(requests=c[0], total_wait=c[1],
+                                             max_wait=c[2]))
+                    for p, c in self.waits.iteritems())
+
+    def close(self):
+        self.map.close()
+        self.file.close()
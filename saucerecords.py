@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Compact records for tunnels and jobs, and indexed collections of them.
+
+    tunnels = sauce_client.list_tunnels(as_records=True)
+    tunnels.find(status='running', domains='example.com')
+"""
+
+
+def _intern(value):
+    # statuses, hosts and domains repeat a lot; share one copy of each
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+class Record(object):
+    """A REST document with its common fields as slotted attributes."""
+
+    __slots__ = ('id', 'extra')
+
+    # (attribute, document key) for each slotted field besides id
+    FIELDS = ()
+
+    @classmethod
+    def from_doc(cls, doc):
+        record = cls.__new__(cls)
+        doc = dict(doc)
+        record.id = doc.pop('_id', None)
+        other_id = doc.pop('id', None)
+        if record.id is None:
+            record.id = other_id
+        for attribute, key in cls.FIELDS:
+            value = doc.pop(key, None)
+            if isinstance(value, list):
+                value = tuple(_intern(v) for v in value)
+            else:
+                value = _intern(value)
+            setattr(record, attribute, value)
+        # whatever else the server sent, kept only when there is some
+        record.extra = doc or None
+        return record
+
+    def to_doc(self):
+        doc = dict(self.extra or {})
+        doc['_id'] = doc['id'] = self.id
+        for attribute, key in self.FIELDS:
+            value = getattr(self, attribute)
+            if isinstance(value, tuple):
+                value = list(value)
+            doc[key] = value
+        return doc
+
+    # dict-style access, so code written against the raw documents
+    # keeps working
+
+    def __getitem__(self, key):
+        if key in ('_id', 'id'):
+            return self.id
+        for attribute, field in self.FIELDS:
+            if field == key:
+                value = getattr(self, attribute)
+                if isinstance(value, tuple):
+                    return list(value)
+                return value
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.id,
+                               getattr(self, 'status', ''))
+
+
+class Tunnel(Record):
+
+    __slots__ = ('status', 'host', 'domains')
+    FIELDS = (('status', 'Status'),
+              ('host', 'Host'),
+              ('domains', 'DomainNames'))
+
+
+class Job(Record):
+
+    __slots__ = ('status', 'batch', 'name')
+    FIELDS = (('status', 'Status'),
+              ('batch', 'Batch'),
+              ('name', 'Name'))
+
+
+class RecordSet(object):
+    """
+    Records by ID plus secondary indexes, so lookups by an indexed
+    attribute are set intersections instead of scans. Attributes holding
+    a tuple, like Tunnel.domains, are indexed under each of their values.
+    """
+
+    record_class = Record
+    INDEXES = ()
+
+    def __init__(self, records=()):
+        self.records = {}
+        self.indexes = dict((name, {}) for name in self.INDEXES)
+        for record in records:
+            self.add(record)
+
+    @classmethod
+    def from_docs(cls, docs):
+        return cls(cls.record_class.from_doc(doc) for doc in docs)
+
+    def _keys(self, record, name):
+        value = getattr(record, name)
+        if isinstance(value, tuple):
+            return value
+        return (value,)
+
+    def add(self, record):
+        """Add record, replacing any record with the same ID."""
+        self.remove(record.id)
+        self.records[record.id] = record
+        for name, index in self.indexes.iteritems():
+            for key in self._keys(record, name):
+                index.setdefault(key, set()).add(record.id)
+
+    def remove(self, record_id):
+        record = self.records.pop(record_id, None)
+        if record is None:
+            return None
+        for name, index in self.indexes.iteritems():
+            for key in self._keys(record, name):
+                ids = index[key]
+                ids.discard(record_id)
+                if not ids:
+                    del index[key]
+        return record
+
+    def get(self, record_id):
+        return self.records.get(record_id)
+
+    def find(self, **criteria):
+        """
+        Return the records matching every attribute=value criterion. The
+        criteria must all be indexed attributes.
+        """
+        if not criteria:
+            return self.records.values()
+        matches = sorted((self.indexes[name].get(value, set())
+                          for name, value in criteria.iteritems()),
+                         key=len)
+        ids = matches[0].intersection(*matches[1:])
+        return [self.records[record_id] for record_id in ids]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return self.records.itervalues()
+
+    def __contains__(self, record_id):
+        return record_id in self.records
+
+
+class TunnelSet(RecordSet):
+
+    record_class = Tunnel
+    INDEXES = ('status', 'host', 'domains')
+
+
+class JobSet(RecordSet):
+
+    record_class = Job
+    INDEXES = ('status', 'batch')
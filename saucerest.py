@@ -22,14 +22,32 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import copy
+import mmap
+import random
+import zlib
 import time
+import anydbm
+import hashlib
+import Queue
+import base64
+import httplib
 import httplib2
 import urllib
+import urlparse
+import email.utils
 import socket
 import logging
+import threading
+from collections import OrderedDict
 
 import simplejson  # http://cheeseshop.python.org/pypi/simplejson
 
+import metrics
+import ratelimit
+import saucerecords
+
 logger = logging.getLogger(__name__)
 
 
@@ -37,6 +55,10 @@ class SauceRestError(Exception):
     pass
 
 
+class CircuitOpenError(SauceRestError):
+    pass
+
+
 def _loads(json):
     try:
         return simplejson.loads(json)
@@ -44,35 +66,778 @@ def _loads(json):
         raise SauceRestError("Invalid JSON response: %s", json)
 
 
+def _imap_ordered(function, items, concurrency):
+    """
+    Call function on every item from a pool of worker threads and yield a
+    (result, error) pair per item, in the order the items were given. At
+    most 2 * concurrency items are taken from the iterable ahead of the
+    consumer, so items can be produced lazily. A concurrency below 1 is
+    treated as 1.
+    """
+    concurrency = max(1, concurrency)
+    tasks = Queue.Queue()
+    results = {}
+    done = threading.Condition()
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            try:
+                outcome = (function(item), None)
+            except Exception, e:
+                outcome = (None, e)
+            done.acquire()
+            try:
+                results[index] = outcome
+                done.notify()
+            finally:
+                done.release()
+
+    workers = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    for thread in workers:
+        thread.setDaemon(True)
+        thread.start()
+
+    items = iter(items)
+    submitted = next_index = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and submitted - next_index < 2 * concurrency:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                tasks.put((submitted, item))
+                submitted += 1
+            if next_index == submitted:
+                return
+
+            done.acquire()
+            try:
+                while next_index not in results:
+                    done.wait()
+                outcome = results.pop(next_index)
+            finally:
+                done.release()
+            next_index += 1
+            yield outcome
+    finally:
+        # the consumer may stop early; drop what has not started yet
+        try:
+            while True:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in workers:
+            tasks.put(None)
+
+
+# Size of the buffer attachments are streamed through
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _iter_json_array(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Decode a JSON array read from stream, yielding each element as soon as
+    it has fully arrived instead of loading the whole document.
+    """
+    decoder = simplejson.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        # skip the separators between elements
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if started and pos < len(buf) and buf[pos] == ']':
+            return
+        if not started and pos < len(buf):
+            if buf[pos] != '[':
+                raise SauceRestError("Invalid JSON response: expected a list,"
+                                     " got %r" % buf[pos:pos + 80])
+            started = True
+            pos += 1
+            continue
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # most likely an element cut off at the end of the buffer
+                if eof:
+                    raise SauceRestError("Invalid JSON response: %r"
+                                         % buf[pos:pos + 80])
+            else:
+                pos = end
+                yield item
+                continue
+        if eof:
+            raise SauceRestError("Truncated JSON response")
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def _iter_mmap(mapping, chunk_size, close=False):
+    try:
+        for offset in xrange(0, len(mapping), chunk_size):
+            # buffers share the mapped pages; nothing is copied
+            yield buffer(mapping, offset, chunk_size)
+    finally:
+        if close:
+            mapping.close()
+
+
+def _iter_gzip(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _upload_chunks(source, chunk_size):
+    """
+    Return (length, chunks) for an upload source, which can be a path, a
+    file object or an mmap. Paths are memory-mapped. length is None when
+    it cannot be known up front.
+    """
+    if isinstance(source, mmap.mmap):
+        return len(source), _iter_mmap(source, chunk_size)
+    if isinstance(source, basestring):
+        f = open(source, 'rb')
+        try:
+            length = os.fstat(f.fileno()).st_size
+            if not length:
+                return 0, iter([])
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        return length, _iter_mmap(mapping, chunk_size, close=True)
+    try:
+        length = os.fstat(source.fileno()).st_size - source.tell()
+    except (AttributeError, IOError, OSError):
+        length = None
+    return length, iter(lambda: source.read(chunk_size), '')
+
+
+# Seconds a cached GET is served without asking the server again. Past
+# that, the cached copy is revalidated with If-None-Match.
+DEFAULT_CACHE_TTLS = {'tunnels': 2, 'jobs': 2, 'scripts': 60}
+
+
+class ResponseCache:
+    """Bounded LRU cache of GET response bodies, keyed by URL."""
+
+    def __init__(self, max_entries=256, ttls=None):
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_CACHE_TTLS)
+        self.ttls.update(ttls or {})
+        self.entries = OrderedDict()    # url -> [expires, etag, content]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def lookup(self, url):
+        """
+        Return (content, etag). content is None unless the entry is still
+        fresh; etag is set when a stale entry can be revalidated.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(url, None)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self.entries[url] = entry
+            if entry[0] > time.time():
+                self.hits += 1
+                return entry[2], None
+            self.misses += 1
+            return None, entry[1]
+        finally:
+            self.lock.release()
+
+    def store(self, url, type, etag, content):
+        self.lock.acquire()
+        try:
+            self.entries.pop(url, None)
+            expires = time.time() + self.ttls.get(type, 0)
+            self.entries[url] = [expires, etag, content]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def revalidated(self, url, type):
+        """Renew an entry after a 304 and return its content."""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            entry[0] = time.time() + self.ttls.get(type, 0)
+            self.revalidations += 1
+            return entry[2]
+        finally:
+            self.lock.release()
+
+    def expire(self, url):
+        """Make the entry for url stale, keeping its ETag to revalidate."""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(url)
+            if entry is not None:
+                entry[0] = 0
+        finally:
+            self.lock.release()
+
+    def invalidate(self, url, subtree=False):
+        """
+        Drop the entry for url, including query-string variants, and with
+        subtree every URL below it as well.
+        """
+        self.lock.acquire()
+        try:
+            for cached_url in self.entries.keys():
+                if cached_url == url or cached_url.startswith(url + "?") or \
+                        (subtree and cached_url.startswith(url + "/")):
+                    del self.entries[cached_url]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return dict(entries=len(self.entries), hits=self.hits,
+                    misses=self.misses, revalidations=self.revalidations,
+                    evictions=self.evictions)
+
+
+# Methods that can be resent after a failure without doing anything twice
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# Statuses worth retrying. The first two mean the server turned the request
+# away, so even a POST can be resent.
+REJECTED_STATUSES = (429, 503)
+RETRY_STATUSES = REJECTED_STATUSES + (500, 502, 504)
+
+
+def _retry_after(response):
+    """Return the Retry-After of response in seconds, or None."""
+    if hasattr(response, 'getheader'):
+        value = response.getheader('retry-after')
+    else:
+        value = response.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class CircuitBreaker:
+    """
+    Fails calls to a host fast once it keeps failing. After `threshold`
+    failures in a row the breaker opens and calls raise CircuitOpenError
+    for reset_timeout seconds; then a single trial call is let through,
+    and its outcome closes the breaker or opens it again.
+    """
+
+    def __init__(self, host, threshold=5, reset_timeout=30):
+        self.host = host
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        self.lock.acquire()
+        try:
+            if self.opened_at is None:
+                return
+            if self.trial_running or \
+                    time.time() < self.opened_at + self.reset_timeout:
+                raise CircuitOpenError("Not calling %s: too many recent"
+                                       " failures" % self.host)
+            self.trial_running = True
+        finally:
+            self.lock.release()
+
+    def succeeded(self):
+        self.lock.acquire()
+        try:
+            if self.opened_at is not None:
+                logger.info("Requests to %s are working again", self.host)
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+        finally:
+            self.lock.release()
+
+    def failed(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning("%d failed requests to %s in a row,"
+                                   " backing off for %gs", self.failures,
+                                   self.host, self.reset_timeout)
+                self.opened_at = time.time()
+        finally:
+            self.lock.release()
+
+
+class RetryPolicy:
+    """
+    Retries failed requests with exponential backoff and full jitter, so
+    many clients failing at the same moment don't retry in lockstep.
+    Honours Retry-After, only resends requests that are safe to resend,
+    and keeps a CircuitBreaker per host. Each SauceClient gets a policy of
+    its own unless one is passed in; pass the same policy to clients that
+    should back off together.
+    """
+
+    def __init__(self, max_tries=4, base_delay=0.5, max_delay=30,
+                 breaker_threshold=5, breaker_reset_timeout=30):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, host):
+        self.lock.acquire()
+        try:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(
+                    host, self.breaker_threshold, self.breaker_reset_timeout)
+            return self.breakers[host]
+        finally:
+            self.lock.release()
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number attempt (from 1)."""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def wait(self, attempt, retry_after=None):
+        time.sleep(self.delay(attempt, retry_after))
+
+    def single_try(self):
+        """Return a policy trying each request once, sharing breakers."""
+        policy = copy.copy(self)
+        policy.max_tries = 1
+        return policy
+
+    def call(self, host, method, request, resend=True):
+        """
+        Run request(), which returns (response, content), until it
+        succeeds, runs out of tries or fails in a way that is not safe to
+        retry. Errors are raised as SauceRestError; the last response is
+        returned if every try got a retryable status. With resend=False
+        the request is only made once. Whatever the number of tries, the
+        call counts once for the breaker.
+        """
+        breaker = self.breaker(host)
+        breaker.before_call()
+        try:
+            response, content = self._retry(host, method, request,
+                                             resend and self.max_tries or 1)
+        except:
+            # anything at all, so a half-open breaker never stays stuck
+            breaker.failed()
+            raise
+        if response.status in RETRY_STATUSES:
+            breaker.failed()
+        else:
+            breaker.succeeded()
+        return response, content
+
+    def _retry(self, host, method, request, max_tries):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response, content = request()
+            except SauceRestError, e:
+                if method not in IDEMPOTENT_METHODS or attempt >= max_tries:
+                    raise
+                retry_after = None
+                logger.warning("%s request to %s failed (%s), retrying",
+                               method, host, e)
+            else:
+                if response.status not in RETRY_STATUSES or \
+                        attempt >= max_tries or not (
+                            method in IDEMPOTENT_METHODS or
+                            response.status in REJECTED_STATUSES):
+                    return response, content
+                retry_after = _retry_after(response)
+                if hasattr(response, 'close'):
+                    response.close()
+                logger.warning("%s request to %s got status %d, retrying",
+                               method, host, response.status)
+            self.wait(attempt, retry_after)
+
+
+def _request_priority(method, uri):
+    """
+    Rate limiter priority for a request: anything keeping tunnels alive
+    goes first, listings last.
+    """
+    parts = urlparse.urlsplit(uri)[2].strip('/').split('/')
+    type = len(parts) > 2 and parts[2] or None
+    if type == 'tunnels' and (len(parts) > 3 or method != 'GET'):
+        return ratelimit.HIGH
+    if method == 'GET' and len(parts) <= 3:
+        return ratelimit.LOW
+    return ratelimit.NORMAL
+
+
+class _HttpPool:
+    """
+    Bounded pool of httplib2.Http objects, each used by one thread at a
+    time. Checking out blocks while all of them are busy. The most recently
+    returned connection is handed out first, as it is the most likely to
+    still be open.
+    """
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def checkout(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            try:
+                return self.factory()
+            except:
+                self.slots.release()
+                raise
+
+    def checkin(self, http, broken=False):
+        """Give http back; a broken one is dropped and replaced later."""
+        if not broken:
+            self.idle.put(http)
+        self.slots.release()
+
+    def reserve(self):
+        """Take a slot for a connection made outside the pool."""
+        self.slots.acquire()
+
+    def release(self):
+        self.slots.release()
+
+
+class _PooledResponse:
+    """httplib response holding a slot of an _HttpPool until closed."""
+
+    def __init__(self, response, pool):
+        self.response = response
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def close(self):
+        self.response.close()
+        if self.pool is not None:
+            self.pool.release()
+            self.pool = None
+
+
+class ScriptIndex:
+    """
+    On-disk index of uploaded script attachments, keyed by the SHA-1 of
+    their content, so identical uploads can reuse the script already on
+    the server. Entries older than ttl seconds are dropped.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.db = anydbm.open(path, 'c')
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def lookup(self, digest):
+        """Return (script_id, name) for digest, or None."""
+        self.lock.acquire()
+        try:
+            if not self.db.has_key(digest):
+                return None
+            entry = simplejson.loads(self.db[digest])
+            if entry['time'] + self.ttl < time.time():
+                del self.db[digest]
+                return None
+            return entry['script_id'], entry['name']
+        finally:
+            self.lock.release()
+
+    def add(self, digest, script_id, name):
+        self.lock.acquire()
+        try:
+            self.db[digest] = simplejson.dumps(
+                dict(script_id=script_id, name=name, time=time.time()))
+            if hasattr(self.db, 'sync'):
+                self.db.sync()
+        finally:
+            self.lock.release()
+
+    def discard(self, digest):
+        self.lock.acquire()
+        try:
+            if self.db.has_key(digest):
+                del self.db[digest]
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.db.close()
+
+
+# Statuses of a tunnel that can be forwarded through once its host answers
+# SSH; a booting tunnel often does well before it reports running.
+USABLE_TUNNEL_STATUSES = ('running', 'booting')
+
+
 class SauceClient:
-    """Basic wrapper class for operations with Sauce"""
+    """
+    Basic wrapper class for operations with Sauce
+
+    A client can be shared between threads. Requests check a connection
+    out of a pool of at most max_connections, so that many requests can be
+    in flight at once. Streamed transfers count against the same limit
+    until their response is closed.
+    """
 
     def __init__(self, name=None, access_key=None,
                  base_url="https://saucelabs.com",
-                 timeout=30):
+                 timeout=30,
+                 max_connections=8,
+                 cache_size=0,
+                 cache_ttls=None,
+                 script_index=None,
+                 script_index_ttl=7 * 24 * 3600,
+                 retry_policy=None,
+                 rate_limiter=None,
+                 client_metrics=None):
         if base_url.endswith('/'):
             base_url = base_url[:-1]
         self.base_url = base_url
         self.account_name = name
+        self.access_key = access_key
+        self.timeout = timeout
         self.unhealthy_tunnels = set()
-        self.http = httplib2.Http(timeout=timeout)
-        self.http.add_credentials(name, access_key)
+        self.unhealthy_tunnels_lock = threading.Lock()
+        self.http_pool = _HttpPool(self._new_http, max_connections)
+        # Opt-in cache for tunnel/job/script lookups; see ResponseCache
+        self.cache = None
+        if cache_size:
+            self.cache = ResponseCache(cache_size, cache_ttls)
+        # Opt-in dedupe of script uploads, persisted at this path
+        self.script_index = None
+        if script_index:
+            self.script_index = ScriptIndex(script_index, script_index_ttl)
+
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Opt-in ratelimit.SharedRateLimiter, usually shared across processes
+        self.rate_limiter = rate_limiter
+        # Pass client_metrics=False to skip recording request metrics
+        if client_metrics is None:
+            client_metrics = metrics.ClientMetrics()
+        self.metrics = client_metrics or None
+        self._rest_prefix = self.base_url + "/rest/%s/" % name
 
         # Used for job/batch waiting
         self.SLEEP_INTERVAL = 5   # in seconds
         self.TIMEOUT = 300  # TIMEOUT/60 = number of minutes before timing out
 
+    def single_try(self):
+        """
+        Return a client sharing this one's connections, cache and breakers
+        whose requests are tried only once, for callers that retry on
+        their own and would otherwise multiply the retries.
+        """
+        client = copy.copy(self)
+        client.retry_policy = self.retry_policy.single_try()
+        return client
+
+    def _new_http(self):
+        http = httplib2.Http(timeout=self.timeout)
+        http.add_credentials(self.account_name, self.access_key)
+        return http
+
     def _http_request(self, uri, method, **keywords):
-        """Wrap the HTTP request up so we get reasonable error handling."""
+        """
+        Wrap the HTTP request up so we get reasonable error handling, and
+        retries according to self.retry_policy.
+        """
+        return self.retry_policy.call(
+            urlparse.urlsplit(uri)[1], method,
+            lambda: self._send_request(uri, method, **keywords))
+
+    def _resource(self, uri):
+        """Return the resource type, like 'tunnels', uri refers to."""
+        if uri.startswith(self._rest_prefix):
+            return uri[len(self._rest_prefix):].split('/', 1)[0].split('?')[0]
+        return 'other'
+
+    def _send_request(self, uri, method, **keywords):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(_request_priority(method, uri))
+        http = self.http_pool.checkout()
+        start = time.time()
         try:
-            return self.http.request(uri, method, **keywords)
+            response, content = http.request(uri, method, **keywords)
         except (httplib2.ServerNotFoundError, socket.error), e:
+            self.http_pool.checkin(http, broken=True)
+            self._observe(method, uri, start, None, keywords.get('body'))
             raise SauceRestError(
                 "HTTP request failed for %s: %s" % (self.base_url, e))
         except AttributeError:
+            self.http_pool.checkin(http, broken=True)
+            self._observe(method, uri, start, None, keywords.get('body'))
             # httplib2 errors suck
             raise SauceRestError("HTTP request failed for %s (httplib2"
                 " maybe couldn't create socket/connection)" % self.base_url)
+        except:
+            self.http_pool.checkin(http, broken=True)
+            raise
+        self.http_pool.checkin(http)
+        self._observe(method, uri, start, response.status,
+                      keywords.get('body'), content)
+        return response, content
+
+    def _observe(self, method, uri, start, status, body=None, content=None):
+        if self.metrics is None:
+            return
+        sent = received = 0
+        if isinstance(body, str):
+            sent = len(body)
+        if content:
+            received = len(content)
+        self.metrics.observe(method, self._resource(uri), time.time() - start,
+                             status, sent, received)
+
+    def _open_stream(self, method, url, headers=None, body=None):
+        """
+        Send a request on its own connection and return the httplib
+        response with the body still unread. For transfers too large to
+        go through httplib2, which always reads the whole body.
+
+        body may be a string or an iterable of chunks; chunks are sent as
+        they come, chunk-encoded unless headers give a Content-Length.
+        Since chunks can only be sent once, such requests aren't retried.
+        """
+        return self.retry_policy.call(
+            urlparse.urlsplit(url)[1], method,
+            lambda: (self._send_stream(method, url, headers, body), None),
+            resend=body is None or isinstance(body, str))[0]
+
+    def _send_stream(self, method, url, headers, body):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(_request_priority(method, url))
+        self.http_pool.reserve()
+        start = time.time()
+        try:
+            response = self._do_send_stream(method, url, headers, body)
+        except:
+            self.http_pool.release()
+            self._observe(method, url, start, None, body)
+            raise
+        # the body is read later, so only the time to the headers counts
+        self._observe(method, url, start, response.status, body)
+        return _PooledResponse(response, self.http_pool)
+
+    def _do_send_stream(self, method, url, headers, body):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        if query:
+            path = "%s?%s" % (path, query)
+        headers = dict(headers or {})
+        headers['Authorization'] = "Basic " + base64.b64encode(
+            "%s:%s" % (self.account_name, self.access_key))
+        try:
+            if body is None or isinstance(body, str):
+                connection.request(method, path, body, headers)
+                return connection.getresponse()
+            connection.putrequest(method, path)
+            for key, value in headers.iteritems():
+                connection.putheader(key, value)
+            chunked = 'Content-Length' not in headers
+            if chunked:
+                connection.putheader('Transfer-Encoding', 'chunked')
+            connection.endheaders()
+            for chunk in body:
+                if not chunked:
+                    connection.send(chunk)
+                elif chunk:
+                    connection.send("%x\r\n%s\r\n" % (len(chunk), chunk))
+            if chunked:
+                connection.send("0\r\n\r\n")
+            return connection.getresponse()
+        except (httplib.HTTPException, socket.error), e:
+            connection.close()
+            raise SauceRestError(
+                "HTTP request failed for %s: %s" % (self.base_url, e))
+
+    def _cached_get(self, url, type, headers):
+        """GET url through the response cache, returning the body."""
+        if self.cache is None:
+            return self._http_request(url, 'GET', headers=headers)[1]
+        content, etag = self.cache.lookup(url)
+        if content is not None:
+            return content
+        request_headers = headers
+        if etag:
+            request_headers = dict(headers)
+            request_headers['If-None-Match'] = etag
+        response, content = self._http_request(url, 'GET',
+                                               headers=request_headers)
+        if response.status == 304:
+            content = self.cache.revalidated(url, type)
+            if content is not None:
+                return content
+            # evicted while we were asking
+            response, content = self._http_request(url, 'GET',
+                                                   headers=headers)
+        if response.status == 200:
+            self.cache.store(url, type, response.get('etag'), content)
+        return content
+
+    def _invalidate(self, type, doc_id=None):
+        """Forget cached listings of type and, if given, document doc_id."""
+        if self.cache is None:
+            return
+        url = self.base_url + "/rest/%s/%s" % (self.account_name, type)
+        self.cache.invalidate(url)
+        if doc_id is not None:
+            self.cache.invalidate("%s/%s" % (url, doc_id), subtree=True)
 
     def get(self, type, doc_id, **kwargs):
         headers = {"Content-Type": "application/json"}
@@ -88,17 +853,65 @@ class SauceClient:
                                                       doc_id,
                                                       attachment,
                                                       parameters)
-        response, content = self._http_request(url, 'GET', headers=headers)
         if attachment:
+            response, content = self._http_request(url, 'GET',
+                                                   headers=headers)
             return content
         else:
-            return _loads(content)
+            return _loads(self._cached_get(url, type, headers))
 
-    def list(self, type):
+    def list(self, type, **kwargs):
         headers = {"Content-Type": "application/json"}
-        url = self.base_url + "/rest/%s/%s" % (self.account_name, type)
-        response, content = self._http_request(url, 'GET', headers=headers)
-        return _loads(content)
+        if kwargs:
+            parameters = "?%s" % (urllib.urlencode(kwargs, doseq=True))
+        else:
+            parameters = ""
+        url = self.base_url + "/rest/%s/%s%s" % (self.account_name,
+                                                 type,
+                                                 parameters)
+        return _loads(self._cached_get(url, type, headers))
+
+    def iter_docs(self, type, page_size=100, **filters):
+        """
+        Yield the documents list() would return one at a time. They are
+        fetched page_size per request, using the limit and skip query
+        parameters, and each page is decoded as it streams in, so stopping
+        early saves both the download and the memory for the rest. While a
+        page is being read it holds one of the client's max_connections.
+        """
+        headers = {"Content-Type": "application/json"}
+        skip = 0
+        first = None
+        while True:
+            parameters = dict(filters, limit=page_size, skip=skip)
+            url = self.base_url + "/rest/%s/%s?%s" % (
+                self.account_name, type,
+                urllib.urlencode(parameters, doseq=True))
+            response = self._open_stream('GET', url, headers)
+            count = 0
+            try:
+                if response.status != 200:
+                    raise SauceRestError("Listing %s failed: %d %s"
+                                         % (type, response.status,
+                                            response.reason))
+                for doc in _iter_json_array(response):
+                    if not skip and not count:
+                        first = doc
+                    elif skip and not count and doc == first:
+                        # the server ignored skip, or ignored limit and
+                        # had exactly page_size documents: all sent
+                        logger.warning("Server repeated the first page of"
+                                       " %s, stopping", type)
+                        return
+                    count += 1
+                    yield doc
+            finally:
+                response.close()
+            if count != page_size:
+                # a short page is the last one; a long one means the
+                # server ignored limit and sent everything
+                return
+            skip += count
 
     def create(self, type, body):
         headers = {"Content-Type": "application/json"}
@@ -108,22 +921,183 @@ class SauceClient:
                                               'POST',
                                               body=body,
                                               headers=headers)
+        self._invalidate(type)
+        return _loads(content)
+
+    def update(self, type, doc_id, body):
+        """Set the fields in body on an existing document."""
+        headers = {"Content-Type": "application/json"}
+        url = self.base_url + "/rest/%s/%s/%s" % (self.account_name,
+                                                  type,
+                                                  doc_id)
+        body = simplejson.dumps(body)
+        response, content = self._http_request(url,
+                                              'PUT',
+                                              body=body,
+                                              headers=headers)
+        self._invalidate(type, doc_id)
         return _loads(content)
 
     def attach(self, doc_id, name, body):
         url = self.base_url + "/rest/%s/scripts/%s/%s" % (self.account_name,
                                                           doc_id, name)
         response, content = self._http_request(url, 'PUT', body=body)
+        self._invalidate('scripts', doc_id)
         return _loads(content)
 
+    def attach_file(self, doc_id, name, source, compress=False,
+                    chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Like attach(), but streams the body from source, which can be a
+        path, a file object or an mmap, chunk_size bytes at a time. With
+        compress the body is gzipped on the fly and sent chunk-encoded.
+        """
+        return _loads(self._attach_stream(doc_id, name, source, compress,
+                                          chunk_size)[1])
+
+    def _attach_stream(self, doc_id, name, source, compress=False,
+                       chunk_size=STREAM_CHUNK_SIZE):
+        """Do the upload for attach_file(); return (status, content)."""
+        url = self.base_url + "/rest/%s/scripts/%s/%s" % (self.account_name,
+                                                          doc_id, name)
+        length, chunks = _upload_chunks(source, chunk_size)
+        headers = {}
+        if compress:
+            chunks = _iter_gzip(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        elif length is not None:
+            headers['Content-Length'] = str(length)
+        response = self._open_stream('PUT', url, headers, chunks)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+        self._invalidate('scripts', doc_id)
+        return response.status, content
+
+    def attach_files(self, items, workers=4, **kwargs):
+        """
+        Upload many attachments at once with a pool of `workers` threads.
+        items yields (doc_id, name, source) tuples. Yields a (result,
+        error) pair per item, in order; other keyword arguments go to
+        attach_file().
+        """
+        def upload((doc_id, name, source)):
+            return self.attach_file(doc_id, name, source, **kwargs)
+        return _imap_ordered(upload, items, workers)
+
     def delete(self, type, doc_id):
         headers = {"Content-Type": "application/json"}
         url = self.base_url + "/rest/%s/%s/%s" % (self.account_name,
                                                   type,
                                                   doc_id)
         response, content = self._http_request(url, 'DELETE', headers=headers)
+        self._invalidate(type, doc_id)
         return _loads(content)
 
+    def download(self, type, doc_id, attachment, dest,
+                 chunk_size=STREAM_CHUNK_SIZE, max_resumes=3):
+        """
+        Stream an attachment into dest, a path or a writable file object,
+        chunk_size bytes at a time. Returns the attachment size.
+
+        A transfer that breaks off is resumed with a Range request, up to
+        max_resumes times. If dest is a path that already holds the start
+        of the attachment, the download carries on from there. A file
+        this call creates is removed again if the download fails before
+        any of it arrives.
+        """
+        url = self.base_url + "/rest/%s/%s/%s/%s" % (self.account_name,
+                                                     type,
+                                                     doc_id,
+                                                     attachment)
+        created = False
+        if isinstance(dest, basestring):
+            created = not os.path.exists(dest)
+            out = open(dest, created and 'wb' or 'r+b')
+            out.seek(0, os.SEEK_END)
+            start, received = 0, out.tell()
+        else:
+            out, received = dest, 0
+            try:
+                start = out.tell()
+            except (AttributeError, IOError):
+                start = None    # not seekable; can resume but not restart
+
+        resumes = 0
+        try:
+            while True:
+                headers = {}
+                if received:
+                    headers['Range'] = "bytes=%d-" % received
+                response = None
+                try:
+                    response = self._open_stream('GET', url, headers)
+                    if response.status == 416:
+                        # nothing past what we already have
+                        return received
+                    if response.status == 200 and received:
+                        if start is None:
+                            raise SauceRestError("Cannot resume download of"
+                                                 " %s: Range not supported"
+                                                 % url)
+                        out.seek(start)
+                        out.truncate()
+                        received = 0
+                    elif response.status not in (200, 206):
+                        raise SauceRestError("Download of %s failed: %d %s"
+                                             % (url, response.status,
+                                                response.reason))
+                    length = response.getheader('content-length')
+                    expected = length and received + int(length)
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                        received += len(chunk)
+                    if not expected or received >= expected:
+                        return received
+                    error = "got %d of %d bytes" % (received, expected)
+                except (httplib.HTTPException, socket.error), e:
+                    error = e
+                finally:
+                    if response is not None:
+                        response.close()
+                resumes += 1
+                if resumes > max_resumes:
+                    raise SauceRestError("Download of %s failed after %d"
+                                         " resumes: %s"
+                                         % (url, max_resumes, error))
+                logger.warning("Download of %s interrupted (%s), resuming at"
+                               " byte %d", url, error, received)
+        except SauceRestError:
+            # an empty file we made would later pass for a partial download
+            if created and not received:
+                out.close()
+                try:
+                    os.remove(dest)
+                except OSError:
+                    pass
+            raise
+        finally:
+            if out is not dest:
+                out.close()
+
+    def download_attachments(self, items, dest_dir, type='jobs', workers=4,
+                             **kwargs):
+        """
+        Download many attachments at once with a pool of `workers`
+        threads. items yields (doc_id, attachment) pairs; each is saved as
+        <dest_dir>/<doc_id>_<attachment>. Yields a (path, error) pair per
+        item, in order; other keyword arguments go to download().
+        """
+        def fetch((doc_id, attachment)):
+            path = os.path.join(dest_dir, "%s_%s" % (doc_id, attachment))
+            self.download(type, doc_id, attachment, path, **kwargs)
+            return path
+        return _imap_ordered(fetch, items, workers)
+
     #------ Sauce-specific objects ------
 
     # Scripts
@@ -134,56 +1108,185 @@ class SauceClient:
     def get_script(self, script_id):
         return self.get('scripts', doc_id=script_id)
 
+    def upload_script(self, name, source, body=None, **kwargs):
+        """
+        Create a script from body and attach source to it as `name`, as
+        create_script() plus attach_file() would. If the client keeps a
+        script_index and the same content was uploaded before under the
+        same name and body, and that script still exists on the server,
+        nothing is sent and the earlier upload is reused. Sources that
+        can't be rewound are always uploaded. Returns (script_id, name) of
+        the attachment.
+        """
+        digest = None
+        rewind = None
+        seekable = True
+        if (self.script_index is not None
+                and not isinstance(source, (basestring, mmap.mmap))):
+            # pipes and sockets can't be read twice, so they go unindexed
+            try:
+                rewind = source.tell()
+                source.seek(rewind)
+            except (AttributeError, IOError, OSError):
+                seekable = False
+        if self.script_index is not None and seekable:
+            # the same bytes under another name or body are another script
+            sha = hashlib.sha1()
+            sha.update(simplejson.dumps([name, body or {}], sort_keys=True))
+            for chunk in _upload_chunks(source, STREAM_CHUNK_SIZE)[1]:
+                sha.update(chunk)
+            if rewind is not None:
+                source.seek(rewind)
+            digest = sha.hexdigest()
+            reference = self.script_index.lookup(digest)
+            if reference:
+                try:
+                    script = self.get_script(reference[0])
+                except SauceRestError, e:
+                    logger.warning("Could not check script %s: %s",
+                                   reference[0], e)
+                    script = None
+                if script and 'error' not in script:
+                    logger.debug("Reusing script %s/%s for %s", reference[0],
+                                 reference[1], name)
+                    return reference
+                self.script_index.discard(digest)
+
+        script = self.create_script(body or {})
+        if 'error' in script:
+            raise SauceRestError("Could not create script: %s"
+                                 % script['error'])
+        script_id = script.get('_id', script.get('id'))
+        status, content = self._attach_stream(script_id, name, source,
+                                              **kwargs)
+        attached = _loads(content)
+        error = isinstance(attached, dict) and attached.get('error')
+        if error or not 200 <= status < 300:
+            # never index an upload the server doesn't have
+            raise SauceRestError("Could not attach %s to script %s: %s"
+                                 % (name, script_id, error or status))
+        if digest:
+            self.script_index.add(digest, script_id, name)
+        return script_id, name
+
     # Jobs
 
     def create_job(self, body):
         return self.create('jobs', body)
 
-    def get_job(self, job_id):
-        return self.get('jobs', job_id)
+    def create_jobs(self, bodies, concurrency=8):
+        """
+        Submit many jobs at once over `concurrency` keep-alive connections.
 
-    def list_jobs(self):
-        return self.list('jobs')
+        Yields a (job, error) pair per body, in the order the bodies were
+        given, as soon as that job and every job before it has been posted.
+        error is None on success; otherwise job is None and error is the
+        SauceRestError raised for that body. No more than the client's
+        max_connections requests are in flight, whatever `concurrency` is.
+        """
+        def submit(body):
+            job = self.create_job(body)
+            if 'error' in job:
+                raise SauceRestError("Could not create job: %s"
+                                     % job['error'])
+            return job
 
-    def wait_for_jobs(self, batch_id):
-        t = 0
-        while t < self.TIMEOUT:
-            jobs = self.get_jobs(batch=batch_id)
-            total_comp = len([j for j in jobs if j['Status'] == 'complete'])
-            total_err = len([j for j in jobs if j['Status'] == 'error'])
+        return _imap_ordered(submit, bodies, concurrency)
 
-            if total_comp + total_err == len(jobs):
-                return
+    def get_job(self, job_id):
+        return self.get('jobs', job_id)
+
+    def list_jobs(self, as_records=False, **filters):
+        jobs = self.list('jobs', **filters)
+        if as_records:
+            return saucerecords.JobSet.from_docs(jobs)
+        return jobs
 
-            time.sleep(self.SLEEP_INTERVAL)
-            t += self.SLEEP_INTERVAL
+    def iter_jobs(self, status=None, batch=None, since=None, until=None,
+                  page_size=100, **filters):
+        """
+        Lazily page through jobs, see iter_docs(). status and batch may be
+        a value or a list of values; since and until bound the creation
+        time, in seconds since the epoch.
+        """
+        for key, value in (('status', status), ('batch', batch),
+                           ('since', since), ('until', until)):
+            if value is not None:
+                filters[key] = value
+        return self.iter_docs('jobs', page_size, **filters)
 
-        if t >= self.TIMEOUT:
-            raise Exception("Timed out waiting for all jobs to finish")
+    def wait_for_jobs(self, batch_id, callback=None):
+        """
+        Block until every job of batch_id (or of each batch in a list of
+        IDs) is complete or errored. callback, if given, is called with
+        each job as it finishes.
+        """
+        if isinstance(batch_id, basestring):
+            batch_id = [batch_id]
+        waiter = JobWaiter(self, batch_id, on_job_done=callback,
+                           max_interval=self.SLEEP_INTERVAL)
+        waiter.wait(self.TIMEOUT)
 
     # Tunnels
 
     def create_tunnel(self, body):
         return self.create('tunnels', body)
 
-    def get_tunnel(self, tunnel_id):
+    def get_tunnel(self, tunnel_id, fresh=False):
+        """
+        Get tunnel info. With fresh, a cached copy is revalidated with the
+        server rather than served as is.
+        """
+        if fresh and self.cache is not None:
+            self.cache.expire(self.base_url + "/rest/%s/tunnels/%s"
+                              % (self.account_name, tunnel_id))
         return self.get('tunnels', tunnel_id)
 
-    def list_tunnels(self):
-        return self.list('tunnels')
+    def list_tunnels(self, as_records=False):
+        tunnels = self.list('tunnels')
+        if as_records:
+            return saucerecords.TunnelSet.from_docs(tunnels)
+        return tunnels
+
+    def update_tunnel(self, tunnel_id, body):
+        return self.update('tunnels', tunnel_id, body)
 
     def delete_tunnel(self, tunnel_id):
         return self.delete('tunnels', tunnel_id)
 
-    def delete_tunnels_by_domains(self, domains):
+    def delete_tunnels_by_domains(self, domains, concurrency=8):
+        """
+        Shut down every tunnel using any of domains, each tunnel once,
+        with up to `concurrency` deletes in flight. Returns (results,
+        elapsed): results maps tunnel ID to a (response, error) pair, and
+        elapsed is the total time taken in seconds.
+        """
+        start = time.time()
         logger.info(
             "Searching for existing tunnels using requested domains ...")
-        for tunnel in self.list_tunnels():
-            for domain in (d for d in domains if d in tunnel['DomainNames']):
+        tunnels = self.list_tunnels(as_records=True)
+        victims = []
+        for domain in domains:
+            for tunnel in tunnels.find(domains=domain):
                 logger.warning("Tunnel %s is currenty using requested"
-                               " domain %s" % (tunnel['_id'], domain))
-                logger.info("Shutting down tunnel %s" % tunnel['_id'])
-                self.delete_tunnel(tunnel['_id'])
+                               " domain %s" % (tunnel.id, domain))
+                if tunnel.id not in victims:
+                    victims.append(tunnel.id)
+
+        results = {}
+        for tunnel_id in victims:
+            logger.info("Shutting down tunnel %s" % tunnel_id)
+        outcomes = _imap_ordered(self.delete_tunnel, victims, concurrency)
+        for tunnel_id, (response, error) in zip(victims, outcomes):
+            if error is not None:
+                logger.error("Could not shut down tunnel %s: %s",
+                             tunnel_id, error)
+            results[tunnel_id] = (response, error)
+        elapsed = time.time() - start
+        if victims:
+            logger.info("Shut down %d tunnel(s) in %.1fs", len(victims),
+                        elapsed)
+        return results, elapsed
 
     # -- Tunnel utilities
 
@@ -215,21 +1318,141 @@ class SauceClient:
                              connect_tries)
 
 
+    def mark_tunnel_unhealthy(self, tunnel_id):
+        """Make the next is_tunnel_healthy(tunnel_id) return False."""
+        self.unhealthy_tunnels_lock.acquire()
+        try:
+            self.unhealthy_tunnels.add(tunnel_id)
+        finally:
+            self.unhealthy_tunnels_lock.release()
+
     def is_tunnel_healthy(self, tunnel_id):
         """Return whether a tunnel connection is considered healthy."""
-        if tunnel_id in self.unhealthy_tunnels:
-            self.unhealthy_tunnels.remove(tunnel_id)
-            return False
+        self.unhealthy_tunnels_lock.acquire()
+        try:
+            if tunnel_id in self.unhealthy_tunnels:
+                self.unhealthy_tunnels.remove(tunnel_id)
+                return False
+        finally:
+            self.unhealthy_tunnels_lock.release()
         try:
-            tunnel = self.get_tunnel(tunnel_id)
+            tunnel = self.get_tunnel(tunnel_id, fresh=True)
         except SauceRestError, e:
             logger.warning("Could not get tunnel info: %s" % e)
             return False
-        if tunnel['Status'] != 'running':
+        if tunnel['Status'] not in USABLE_TUNNEL_STATUSES:
             logger.debug(
                 "Tunnel has non-running status '%s'" % tunnel['Status'])
             return False
         return self._is_ssh_host_up(tunnel['Host'])
 
     def prune_unhealthy_tunnels(self, tunnels_of_concern):
-        self.unhealthy_tunnels.intersection_update(tunnels_of_concern)
+        self.unhealthy_tunnels_lock.acquire()
+        try:
+            self.unhealthy_tunnels.intersection_update(tunnels_of_concern)
+        finally:
+            self.unhealthy_tunnels_lock.release()
+
+
+FINISHED_JOB_STATUSES = ('complete', 'error')
+
+
+class JobWaiter:
+    """
+    Wait on the jobs of many batches at once.
+
+    Each round issues a single list_jobs call covering every batch that
+    still has unfinished jobs, and only jobs whose status changed since
+    the last round are looked at. If the server doesn't say which batch
+    each job belongs to, batches are listed one call each instead. Rounds start min_interval apart and
+    back off by `backoff` up to max_interval while nothing changes.
+    """
+
+    def __init__(self, sauce_client, batch_ids=(), on_job_done=None,
+                 min_interval=1, max_interval=30, backoff=1.5):
+        self.sauce_client = sauce_client
+        self.on_job_done = on_job_done
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.statuses = {}      # job id -> last seen status
+        self.unfinished = {}    # batch id -> number of unfinished jobs
+        self.polled = set()     # batches seen in at least one poll
+        self.per_batch = False  # list each batch on its own
+        for batch_id in batch_ids:
+            self.add(batch_id)
+
+    def add(self, batch_id):
+        self.unfinished.setdefault(batch_id, 0)
+
+    def active_batches(self):
+        return [b for b, count in self.unfinished.iteritems()
+                if count or b not in self.polled]
+
+    def is_done(self, batch_id=None):
+        if batch_id is None:
+            return not self.active_batches()
+        return batch_id in self.polled and not self.unfinished[batch_id]
+
+    def _list(self, batches):
+        """Return (batch id, job) for every job of batches."""
+        if len(batches) > 1 and not self.per_batch:
+            jobs = self.sauce_client.list_jobs(batch=batches)
+            if all(job.get('Batch') is not None for job in jobs):
+                return [(job['Batch'], job) for job in jobs]
+            logger.info("Jobs don't say which batch they are in, listing"
+                        " batches one at a time")
+            self.per_batch = True
+        return [(batch_id, job) for batch_id in batches
+                for job in self.sauce_client.list_jobs(batch=batch_id)]
+
+    def poll(self):
+        """Run one polling round and return the jobs that just finished."""
+        batches = self.active_batches()
+        if not batches:
+            return []
+        finished = []
+        for batch_id, job in self._list(batches):
+            if batch_id not in self.unfinished:
+                continue
+            job_id = job.get('_id', job.get('id'))
+            status = job['Status']
+            old_status = self.statuses.get(job_id)
+            if status == old_status:
+                continue
+            self.statuses[job_id] = status
+            was_done = old_status in FINISHED_JOB_STATUSES
+            is_done = status in FINISHED_JOB_STATUSES
+            # a job counts as unfinished from when it is seen until done
+            self.unfinished[batch_id] += (
+                (not is_done) - (old_status is not None and not was_done))
+            if is_done and not was_done:
+                finished.append(job)
+                if self.on_job_done:
+                    self.on_job_done(job)
+        self.polled.update(batches)
+        return finished
+
+    def iter_finished(self, timeout=None):
+        """Yield jobs as they finish until every batch is done."""
+        deadline = timeout and time.time() + timeout
+        while True:
+            finished = self.poll()
+            for job in finished:
+                yield job
+            if self.is_done():
+                return
+            if finished:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_interval)
+            if deadline and time.time() + self.interval > deadline:
+                raise SauceRestError("Timed out waiting for all jobs to"
+                                     " finish")
+            time.sleep(self.interval)
+
+    def wait(self, timeout=None):
+        for job in self.iter_finished(timeout):
+            pass
@@ -23,15 +23,393 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import time
+import struct
 import logging
+import collections
 
-from twisted.internet import defer, protocol, reactor, task
+from twisted.internet import defer, endpoints, protocol, reactor, task
 from twisted.conch.error import ConchError
 from twisted.conch.ssh import (
-    connection, channel, userauth, transport, forwarding)
+    common, connection, channel, userauth, transport, forwarding)
 
 logger = logging.getLogger(__name__)
 
+# RTT assumed for window growth until the connection has measured one
+DEFAULT_RTT = 0.1
+
+# channel number and data length, leading a channel data message
+_DATA_HEADER = struct.Struct('>2L')
+
+
+class ChannelSettings:
+    """
+    Tuning for forwarded channels. window_size and max_packet are the
+    local window and largest packet offered to the tunnel host, in bytes;
+    None keeps Conch's defaults (128KB and 32KB). If max_window is larger
+    than the window, the window grows towards it while the sender keeps it
+    full, which helps on links with a high RTT.
+
+    high_water and low_water bound what each channel buffers in either
+    direction, in bytes; max_buffered, if set, bounds all channels
+    together. See FlowControl.
+
+    With a pool_size, that many connections to each local host and port
+    are made ahead of time, and replaced after pool_idle_timeout seconds
+    unused. See LocalConnectionPool.
+
+    Connecting to the local host gives up after connect_timeout seconds.
+    With max_channels, at most that many forwarded connections to each
+    local host and port are open at once; see AdmissionControl.
+    """
+
+    def __init__(self, window_size=None, max_packet=None, max_window=None,
+                 high_water=256 * 1024, low_water=64 * 1024,
+                 max_buffered=None, pool_size=0, pool_idle_timeout=30,
+                 connect_timeout=30, max_channels=None, max_queued=100,
+                 queue_timeout=30):
+        self.window_size = window_size
+        self.max_packet = max_packet
+        self.max_window = max_window
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_buffered = max_buffered
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self.connect_timeout = connect_timeout
+        self.max_channels = max_channels
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def _write_backlog(transport):
+    """Bytes a Twisted transport has been given but not yet written."""
+    # there's no public API for this; FileDescriptor has kept these for ages
+    return (len(getattr(transport, 'dataBuffer', '')) -
+            getattr(transport, 'offset', 0) +
+            getattr(transport, '_tempDataLen', 0))
+
+
+class FlowControl:
+    """
+    Buffer occupancy of the forwarded channels of a tunnel.
+
+    A channel stops taking data from whichever side fills one of its
+    buffers past high_water: it holds back the SSH window while the local
+    connection can't keep up, and stops reading the local connection while
+    the tunnel host can't. If max_buffered is set, every channel stops
+    once their buffers add up to more than that, until they drain to half.
+    """
+
+    # how often to recount while paused, as local writes drain silently
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, settings=None):
+        settings = settings or ChannelSettings()
+        self.high_water = settings.high_water
+        self.low_water = min(settings.low_water, settings.high_water)
+        self.max_buffered = settings.max_buffered
+        self.channels = set()
+        self.buffered = 0
+        self.peak = 0
+        self.paused = False
+        self.pauses = 0
+        self.poll = None
+
+    def add(self, channel):
+        self.channels.add(channel)
+
+    def remove(self, channel):
+        self.channels.discard(channel)
+        self.update(-channel.buffered)
+
+    def update(self, delta):
+        self.buffered += delta
+        self.peak = max(self.peak, self.buffered)
+        if not self.max_buffered:
+            return
+        if not self.paused and self.buffered > self.max_buffered:
+            logger.warning("%d bytes buffered in %d channels, pausing them",
+                           self.buffered, len(self.channels))
+            self.paused = True
+            self.pauses += 1
+            self.poll = reactor.callLater(self.POLL_INTERVAL, self._poll)
+        elif self.paused and self.buffered <= self.max_buffered // 2:
+            logger.info("%d bytes buffered, resuming channels",
+                        self.buffered)
+            self.paused = False
+        else:
+            return
+        for channel in list(self.channels):
+            channel.flow_changed()
+
+    def _poll(self):
+        self.poll = None
+        for channel in list(self.channels):
+            channel.update_buffered()
+        if self.paused:
+            self.poll = reactor.callLater(self.POLL_INTERVAL, self._poll)
+
+    def stats(self):
+        for channel in list(self.channels):
+            channel.update_buffered()
+        return dict(channels=len(self.channels), buffered=self.buffered,
+                    peak=self.peak, paused=self.paused, pauses=self.pauses,
+                    holding_window=len([c for c in self.channels
+                                        if c.window_held]),
+                    reading_paused=len([c for c in self.channels
+                                        if c.reading_paused]))
+
+
+def _connect_local(hostport, timeout=30):
+    """Connect a TunnelForwardingClient to hostport; return a Deferred."""
+    endpoint = endpoints.HostnameEndpoint(reactor, hostport[0], hostport[1],
+                                          timeout=timeout)
+    return endpoints.connectProtocol(endpoint, TunnelForwardingClient())
+
+
+class LocalConnectionPool:
+    """
+    Connections made ahead of time to the local hosts and ports forwarded
+    to, so that a forwarded connection needn't wait for its own. Once
+    warm()ed, up to settings.pool_size connections to a target are kept
+    ready; each is closed and replaced after pool_idle_timeout seconds
+    unused, so the local server doesn't time it out first.
+    """
+
+    # seconds before connecting to a target again after a failure, or
+    # after it closed a connection waiting in the pool
+    RETRY_INTERVAL = 5
+
+    def __init__(self, settings=None):
+        settings = settings or ChannelSettings()
+        self.size = settings.pool_size
+        self.idle_timeout = settings.pool_idle_timeout
+        self.connect_timeout = settings.connect_timeout
+        self.idle = {}          # hostport -> [(client, expiry call)]
+        self.connecting = {}    # hostport -> connects in progress
+        self.retry = {}         # hostport -> delayed call to _fill
+        self.closed = False
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.lost = 0
+        self.failed = 0
+
+    def warm(self, hostport):
+        """Start keeping connections to hostport ready."""
+        if hostport not in self.idle:
+            self.idle[hostport] = []
+            self.connecting[hostport] = 0
+            self._fill(hostport)
+
+    def connect(self, hostport):
+        """
+        Return a Deferred firing with a TunnelForwardingClient connected
+        to hostport, from the pool if it has one ready.
+        """
+        idle = self.idle.get(hostport)
+        if not idle:
+            self.misses += 1
+            if idle is not None:
+                self._fill(hostport)
+            return _connect_local(hostport, self.connect_timeout)
+        self.hits += 1
+        client, expiry = idle.pop()
+        expiry.cancel()
+        client.pool = None
+        self._fill(hostport)
+        return defer.succeed(client)
+
+    def _fill(self, hostport):
+        if self.closed or hostport in self.retry:
+            return
+        while len(self.idle[hostport]) + self.connecting[hostport] < self.size:
+            self.connecting[hostport] += 1
+            d = _connect_local(hostport, self.connect_timeout)
+            d.addCallbacks(self._connected, self._failed,
+                           callbackArgs=(hostport,), errbackArgs=(hostport,))
+
+    def _connected(self, client, hostport):
+        self.connecting[hostport] -= 1
+        if self.closed:
+            client.transport.loseConnection()
+            return
+        client.pool = self
+        expiry = reactor.callLater(self.idle_timeout, self._expire,
+                                   hostport, client)
+        self.idle[hostport].append((client, expiry))
+
+    def _failed(self, failure, hostport):
+        self.connecting[hostport] -= 1
+        self.failed += 1
+        logger.debug("pool connection to %s:%s failed: %s",
+                     hostport[0], hostport[1], failure.value)
+        self._retry_later(hostport)
+
+    def _retry_later(self, hostport):
+        if hostport not in self.retry and not self.closed:
+            self.retry[hostport] = reactor.callLater(
+                self.RETRY_INTERVAL, self._retry, hostport)
+
+    def _retry(self, hostport):
+        del self.retry[hostport]
+        self._fill(hostport)
+
+    def _remove(self, hostport, client):
+        for entry in self.idle[hostport]:
+            if entry[0] is client:
+                self.idle[hostport].remove(entry)
+                client.pool = None
+                return entry[1]
+
+    def _expire(self, hostport, client):
+        self._remove(hostport, client)
+        self.expired += 1
+        client.transport.loseConnection()
+        self._fill(hostport)
+
+    def client_lost(self, client):
+        """Called when a connection waiting in the pool is closed."""
+        for hostport, idle in self.idle.items():
+            expiry = self._remove(hostport, client)
+            if expiry:
+                expiry.cancel()
+                self.lost += 1
+                self._retry_later(hostport)
+                return
+
+    def stats(self):
+        return dict(targets=len(self.idle),
+                    idle=sum(len(idle) for idle in self.idle.values()),
+                    connecting=sum(self.connecting.values()),
+                    hits=self.hits, misses=self.misses, expired=self.expired,
+                    lost=self.lost, failed=self.failed)
+
+    def close(self):
+        self.closed = True
+        for call in self.retry.values():
+            call.cancel()
+        self.retry.clear()
+        for hostport in self.idle:
+            while self.idle[hostport]:
+                client, expiry = self.idle[hostport].pop()
+                expiry.cancel()
+                client.pool = None
+                client.transport.loseConnection()
+
+
+class AdmissionControl:
+    """
+    Admission of forwarded connections to each local host and port: at
+    most max_channels are connecting or connected at once, and up to
+    max_queued more wait their turn, each for at most queue_timeout
+    seconds. Opening a channel beyond that is refused with
+    OPEN_RESOURCE_SHORTAGE.
+
+    A waiting channel is already open as far as the tunnel host is
+    concerned, but its window isn't adjusted until it is admitted.
+    """
+
+    def __init__(self, settings=None):
+        settings = settings or ChannelSettings()
+        self.max_channels = settings.max_channels
+        self.max_queued = settings.max_queued
+        self.queue_timeout = settings.queue_timeout
+        self.active = {}        # hostport -> admitted channels
+        self.queues = {}        # hostport -> [(channel, queued at, timeout)]
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.connect_failures = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def check(self, hostport):
+        """Raise a ConchError if a channel to hostport can't even wait."""
+        if (len(self.active.get(hostport, ())) >= self.max_channels and
+                len(self.queues.get(hostport, ())) >= self.max_queued):
+            self.rejected += 1
+            logger.warning("too many connections to %s:%s, refusing one",
+                           hostport[0], hostport[1])
+            raise ConchError(connection.OPEN_RESOURCE_SHORTAGE,
+                             "too many connections to that port")
+
+    def request(self, channel):
+        """Have channel connect now if there is room, or once there is."""
+        hostport = channel.hostport
+        active = self.active.setdefault(hostport, set())
+        if len(active) < self.max_channels:
+            self._admit(channel, 0)
+            return
+        timeout = reactor.callLater(self.queue_timeout, self._timeout,
+                                    channel)
+        self.queues.setdefault(hostport, []).append(
+            (channel, time.time(), timeout))
+
+    def _admit(self, channel, waited):
+        self.active[channel.hostport].add(channel)
+        self.admitted += 1
+        if waited:
+            self.waited += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        channel.connect()
+
+    def _unqueue(self, channel):
+        queue = self.queues.get(channel.hostport, [])
+        for entry in queue:
+            if entry[0] is channel:
+                queue.remove(entry)
+                return entry
+
+    def _timeout(self, channel):
+        self._unqueue(channel)
+        self.timed_out += 1
+        logger.warning("%s waited %ss to connect to %s:%s, closing it",
+                       channel, self.queue_timeout, channel.hostport[0],
+                       channel.hostport[1])
+        channel.loseConnection()
+
+    def release(self, channel):
+        """Called when channel closes, whether admitted or not."""
+        hostport = channel.hostport
+        active = self.active.get(hostport, set())
+        if channel not in active:
+            entry = self._unqueue(channel)
+            if entry and entry[2].active():
+                entry[2].cancel()
+            return
+        active.discard(channel)
+        queue = self.queues.get(hostport)
+        while queue and len(active) < self.max_channels:
+            waiting, queued_at, timeout = queue.pop(0)
+            timeout.cancel()
+            self._admit(waiting, time.time() - queued_at)
+
+    def stats(self):
+        label = lambda hostport: "%s:%s" % hostport
+        return dict(active=dict((label(hostport), len(channels))
+                                for hostport, channels in self.active.items()),
+                    queued=dict((label(hostport), len(queue))
+                                for hostport, queue in self.queues.items()),
+                    admitted=self.admitted, rejected=self.rejected,
+                    timed_out=self.timed_out,
+                    connect_failures=self.connect_failures,
+                    waited=self.waited,
+                    mean_wait=self.waited and self.wait_total / self.waited,
+                    max_wait=self.wait_max)
+
+
+def log_stats(label, stats, interval=60):
+    """Log label and what stats() returns every interval seconds."""
+    task.LoopingCall(lambda: logger.info("%s: %s", label, stats())).start(
+        interval, now=False)
+
 
 class TunnelTransport(transport.SSHClientTransport):
 
@@ -40,11 +418,14 @@ class TunnelTransport(transport.SSHClientTransport):
                  user,
                  password,
                  forward_host,
-                 forward_port,
-                 forward_remote_port,
+                 forward_ports,
                  connected_callback=None,
                  error_callback=None,
-                 diagnostic=False):
+                 diagnostic=False,
+                 settings=None,
+                 flow_control=None,
+                 pool=None,
+                 admission=None):
         try:
             transport.SSHClientTransport.__init__(self)
         except AttributeError:
@@ -53,11 +434,14 @@ class TunnelTransport(transport.SSHClientTransport):
         self.user = user
         self.password = password
         self.forward_host = forward_host
-        self.forward_port = forward_port
-        self.forward_remote_port = forward_remote_port
+        self.forward_ports = forward_ports
         self.connected_callback = connected_callback
         self.error_callback = error_callback
         self.diagnostic = diagnostic
+        self.settings = settings
+        self.flow_control = flow_control
+        self.pool = pool
+        self.admission = admission
         logger.info('%s created', self)
 
     def verifyHostKey(self, hostKey, fingerprint):
@@ -68,11 +452,14 @@ class TunnelTransport(transport.SSHClientTransport):
             TunnelUserAuth(self.user,
                            TunnelConnection(self.tunnel_id,
                                             self.forward_host,
-                                            self.forward_port,
-                                            self.forward_remote_port,
+                                            self.forward_ports,
                                             self.connected_callback,
                                             self.error_callback,
-                                            self.diagnostic),
+                                            self.diagnostic,
+                                            self.settings,
+                                            self.flow_control,
+                                            self.pool,
+                                            self.admission),
                            self.password))
 
     def receiveError(self, reasonCode, description):
@@ -86,6 +473,8 @@ class TunnelTransport(transport.SSHClientTransport):
                        self.tunnel_id, reason)
         if self.error_callback:
             self.error_callback()
+        # closes the forwarded channels, and their local connections
+        transport.SSHClientTransport.connectionLost(self, reason)
 
 
 class TunnelUserAuth(userauth.SSHUserAuthClient):
@@ -126,10 +515,12 @@ class _KeepAlive:
         d = self.conn.sendGlobalRequest("tunnel-keep-alive@saucelabs.com",
                                         "",
                                         wantReply = 1)
-        d.addBoth(self._cbGlobal)
+        d.addBoth(self._cbGlobal, time.time())
         self.globalTimeout = reactor.callLater(30, self._ebGlobal)
 
-    def _cbGlobal(self, res):
+    def _cbGlobal(self, res, sent):
+        # any reply, even a refusal, gives the round trip time
+        self.conn.rtt = time.time() - sent
         if self.globalTimeout:
             self.globalTimeout.cancel()
             self.globalTimeout = None
@@ -141,15 +532,27 @@ class _KeepAlive:
 
 
 class TunnelConnection(connection.SSHConnection):
+    """
+    Asks for a remote forward of each (local port, remote port) pair in
+    forward_ports, and routes forwarded connections by their remote port.
+    connected_callback is called once per accepted forward.
+    """
+
+    # channel class for forwarded connections, TunnelForwardingChannel
+    # if None
+    forwarding_channel = None
 
     def __init__(self,
                  tunnel_id,
                  forward_host,
-                 forward_port,
-                 forward_remote_port,
+                 forward_ports,
                  connected_callback=None,
                  error_callback=None,
-                 diagnostic=False):
+                 diagnostic=False,
+                 settings=None,
+                 flow_control=None,
+                 pool=None,
+                 admission=None):
         try:
             connection.SSHConnection.__init__(self)
         except AttributeError:
@@ -157,18 +560,24 @@ class TunnelConnection(connection.SSHConnection):
 
         self.tunnel_id = tunnel_id
         self.forward_host = forward_host
-        self.forward_port = forward_port
-        self.forward_remote_port = forward_remote_port
+        self.forward_ports = forward_ports
         self.connected_callback = connected_callback
         self.error_callback = error_callback
         self.diagnostic = diagnostic
+        self.settings = settings or ChannelSettings()
+        self.flow_control = flow_control or FlowControl(self.settings)
+        self.pool = pool
+        self.admission = admission
+        self.rtt = None
+        self.stopped = False
 
     def serviceStarted(self):
         self.remoteForwards = {}
         if hasattr(self.transport, 'sendIgnore'):
             _KeepAlive(self)
-        self.requestRemoteForwarding(self.forward_remote_port,
-                                     (self.forward_host, self.forward_port))
+        for local_port, remote_port in self.forward_ports:
+            self.requestRemoteForwarding(remote_port,
+                                         (self.forward_host, local_port))
         self.openChannel(NullChannel())
 
     def requestRemoteForwarding(self, remotePort, hostport):
@@ -185,10 +594,15 @@ class TunnelConnection(connection.SSHConnection):
         logger.info("accepted remote forwarding for tunnel %s %s=>%s:%s",
                     self.tunnel_id, remotePort, hostport[0],hostport[1])
         self.remoteForwards[remotePort] = hostport
+        if self.pool:
+            self.pool.warm(hostport)
         if self.connected_callback:
             self.connected_callback()
 
     def _ebRemoteForwarding(self, f, remotePort, hostport):
+        if self.stopped:
+            # the transport has reported the lost connection
+            return
         logger.error("remote forwarding for tunnel %s %s=>%s:%s failed",
                      self.tunnel_id, remotePort, hostport[0], hostport[1])
         logger.error(str(f))
@@ -205,6 +619,53 @@ class TunnelConnection(connection.SSHConnection):
         except:
             pass
 
+    def ssh_CHANNEL_OPEN(self, packet):
+        # Conch logs every channel it refuses with a traceback; admission
+        # control refusing a burst is routine, so those are refused here
+        channel_type, rest = common.getNS(packet)
+        if self.admission and channel_type == 'forwarded-tcpip':
+            remoteHP, origHP = forwarding.unpackOpen_forwarded_tcpip(
+                rest[12:])
+            if remoteHP[1] in self.remoteForwards:
+                try:
+                    self.admission.check(self.remoteForwards[remoteHP[1]])
+                except ConchError, e:
+                    reason, description = e.args
+                    self.transport.sendPacket(
+                        connection.MSG_CHANNEL_OPEN_FAILURE,
+                        rest[:4] + struct.pack('>L', reason) +
+                        common.NS(description) + common.NS(''))
+                    return
+        connection.SSHConnection.ssh_CHANNEL_OPEN(self, packet)
+
+    def ssh_CHANNEL_DATA(self, packet):
+        localChannel, dataLength = _DATA_HEADER.unpack_from(packet)
+        channel = self.channels[localChannel]
+        if not isinstance(channel, TunnelForwardingChannel):
+            return connection.SSHConnection.ssh_CHANNEL_DATA(self, packet)
+        # as Conch does, but slicing the data out of the packet only once
+        if (dataLength > channel.localWindowLeft or
+                dataLength > channel.localMaxPacket):
+            logger.warning("%s sent too much data, closing it", channel)
+            self.sendClose(channel)
+            return
+        data = packet[8:8 + dataLength]
+        channel.localWindowLeft -= dataLength
+        if channel.localWindowLeft < channel.localWindowSize // 2:
+            self.adjustWindow(channel,
+                              channel.localWindowSize - channel.localWindowLeft)
+        try:
+            channel.dataReceived(data)
+        except Exception:
+            logger.exception("error forwarding data on %s", channel)
+
+    def adjustWindow(self, channel, bytesToAdd):
+        # forwarding channels may hold the window back while buffers drain
+        hold = getattr(channel, 'hold_window', None)
+        if hold and hold():
+            return
+        connection.SSHConnection.adjustWindow(self, channel, bytesToAdd)
+
     def channel_forwarded_tcpip(self, winSize, maxP, data):
         if self.diagnostic:
             logger.debug("FTCP %s" % repr(data))
@@ -215,19 +676,32 @@ class TunnelConnection(connection.SSHConnection):
             connectHP = self.remoteForwards[remoteHP[1]]
             if self.diagnostic:
                 logger.debug("connect forwarding %s", str(connectHP))
-            return forwarding.SSHConnectForwardingChannel(connectHP,
-                                                          remoteWindow=winSize,
-                                                          remoteMaxPacket=maxP,
-                                                          conn = self)
+            channel_class = self.forwarding_channel or TunnelForwardingChannel
+            return channel_class(
+                connectHP,
+                max_window=self.settings.max_window,
+                flow_control=self.flow_control,
+                pool=self.pool,
+                admission=self.admission,
+                connect_timeout=self.settings.connect_timeout,
+                localWindow=self.settings.window_size,
+                localMaxPacket=self.settings.max_packet,
+                remoteWindow=winSize,
+                remoteMaxPacket=maxP,
+                conn=self)
         else:
             raise ConchError(connection.OPEN_CONNECT_FAILED,
                              "don't know about that port")
 
+    def serviceStopped(self):
+        self.stopped = True
+        connection.SSHConnection.serviceStopped(self)
+
     def channelClosed(self, channel):
         if self.diagnostic:
             logger.debug("connection closing %s", channel)
             logger.debug(str(self.channels))
-        if len(self.channels) == 1: # just us left
+        if len(self.channels) == 1 and not self.stopped: # just us left
             logger.warning("stopping connection to a closed tunnel")
             try:
                 #dont stop reactor when one connection is closed
@@ -241,6 +715,268 @@ class TunnelConnection(connection.SSHConnection):
             self.__class__.__bases__[0].channelClosed(self, channel)
 
 
+class TunnelForwardingClient(protocol.Protocol):
+    """
+    Connection to the local host for a TunnelForwardingChannel. What it
+    reads before the channel takes over is kept in `pending`. While it
+    waits in a LocalConnectionPool, `pool` is that pool. `closed` is
+    called once the connection is gone, if set.
+    """
+
+    def __init__(self):
+        self.channel = None
+        self.pending = []
+        self.pool = None
+        self.closed = None
+
+    def dataReceived(self, data):
+        if self.pending is None:
+            self.channel.write(data)
+        else:
+            self.pending.append(data)
+
+    def connectionLost(self, reason):
+        if self.pool:
+            self.pool.client_lost(self)
+        if self.closed:
+            self.closed()
+        if self.channel:
+            self.channel.loseConnection()
+            self.channel = None
+
+
+class TunnelForwardingChannel(forwarding.SSHConnectForwardingChannel):
+    """
+    Forwards a channel to a local host and port. If max_window is larger
+    than the local window, the window grows by WINDOW_GROWTH times, up to
+    max_window, whenever at least half of it arrives within one round
+    trip: the sender is then likely waiting on the window rather than the
+    link.
+
+    Buffering is bounded as flow_control says. Data for the local
+    connection waits in local_buf until it is up, and then in the local
+    transport; the SSH window isn't adjusted while the connection is down
+    or from when the transport holds more than high_water until it has
+    written it all. What the tunnel host has already been allowed to send
+    still arrives, so this direction buffers up to high_water plus the
+    window. Data for the tunnel host waits in self.buf for window, and the
+    local connection isn't read while that is past high_water.
+
+    Unlike Conch's channel, buffers are lists of the chunks as they came
+    rather than ever longer strings, and data is only sliced where a
+    packet or the window ends.
+
+    If given a LocalConnectionPool, the local connection comes from it;
+    if given an AdmissionControl, the channel connects once admitted.
+    """
+
+    # a bigger window takes a round trip to show, so each step is 2 RTTs
+    WINDOW_GROWTH = 4
+
+    def __init__(self, hostport, max_window=None, flow_control=None,
+                 pool=None, admission=None, connect_timeout=30, *args, **kw):
+        forwarding.SSHConnectForwardingChannel.__init__(self, hostport,
+                                                        *args, **kw)
+        self.max_window = max_window
+        self.pool = pool
+        self.admission = admission
+        self.connect_timeout = connect_timeout
+        self.epoch_start = time.time()
+        self.epoch_bytes = 0
+        self.buf = collections.deque()
+        self.buf_bytes = 0
+        self.local_buf = []
+        self.local_buf_bytes = 0
+        self.flow = flow_control or FlowControl()
+        self.flow.add(self)
+        self.buffered = 0
+        self.local_backlogged = False
+        self.reading_paused = False
+        self.window_held = False
+
+    def channelOpen(self, specificData):
+        if self.admission:
+            self.admission.request(self)
+        else:
+            self.connect()
+
+    def connect(self):
+        logger.debug("connecting to %s:%i", *self.hostport)
+        if self.pool:
+            d = self.pool.connect(self.hostport)
+        else:
+            d = _connect_local(self.hostport, self.connect_timeout)
+        d.addCallbacks(self._setClient, self._close)
+
+    def _setClient(self, client):
+        if self.localClosed:
+            # closed while connecting
+            client.transport.loseConnection()
+            return
+        self.client = client
+        client.channel = self
+        # the transport pauses us past bufferSize and resumes us once it
+        # has written everything; that is also how much it reads at once
+        client.transport.bufferSize = min(client.transport.bufferSize,
+                                          self.flow.high_water)
+        client.transport.registerProducer(self, True)
+        if self.local_buf:
+            client.transport.writeSequence(self.local_buf)
+            self.local_buf, self.local_buf_bytes = None, 0
+        pending, client.pending = client.pending, None
+        for data in pending:
+            self.write(data)
+        self.update_buffered()
+
+    def dataReceived(self, data):
+        if self.max_window and self.max_window > self.localWindowSize:
+            self._grow_window(len(data))
+        if self.client:
+            self.client.transport.write(data)
+        else:
+            self.local_buf.append(data)
+            self.local_buf_bytes += len(data)
+        self.update_buffered()
+
+    def write(self, data):
+        if not self.buf:
+            data = self._send(data)
+        if data:
+            if not self.buf:
+                self.areWriting = False
+                self.stopWriting()
+            self.buf.append(data)
+            self.buf_bytes += len(data)
+        if self.closing and not self.buf:
+            self.loseConnection()
+        self.update_buffered()
+
+    def addWindowBytes(self, data):
+        self.remoteWindowLeft += data
+        if not self.areWriting and not self.closing:
+            self.areWriting = True
+            self.startWriting()
+        while self.buf and self.remoteWindowLeft:
+            data = self.buf.popleft()
+            rest = self._send(data)
+            self.buf_bytes -= len(data) - len(rest)
+            if rest:
+                self.buf.appendleft(rest)
+                self.areWriting = False
+                self.stopWriting()
+        if self.closing and not self.buf:
+            self.loseConnection()
+        self.update_buffered()
+
+    def _send(self, data):
+        """Send as much of data as the window allows; return the rest."""
+        if self.localClosed:
+            return ''
+        top = min(len(data), self.remoteWindowLeft)
+        if not top:
+            return data
+        header = _DATA_HEADER.pack
+        remote = self.conn.channelsToRemoteChannel[self]
+        send = self.conn.transport.sendPacket
+        size = self.remoteMaxPacket
+        if top <= size:
+            piece = top < len(data) and data[:top] or data
+            send(connection.MSG_CHANNEL_DATA, header(remote, top) + piece)
+        else:
+            for offset in xrange(0, top, size):
+                piece = data[offset:min(offset + size, top)]
+                send(connection.MSG_CHANNEL_DATA,
+                     header(remote, len(piece)) + piece)
+        self.remoteWindowLeft -= top
+        return data[top:]
+
+    def _close(self, reason):
+        logger.warning("could not connect to %s:%s: %s", self.hostport[0],
+                       self.hostport[1], reason.value)
+        if self.admission:
+            self.admission.connect_failures += 1
+        self.loseConnection()
+
+    def closed(self):
+        client = self.client
+        forwarding.SSHConnectForwardingChannel.closed(self)
+        self.flow.remove(self)
+        if not self.admission:
+            return
+        # the local connection counts until it is closed, not just closing
+        if client and not client.transport.disconnected:
+            client.closed = lambda: self.admission.release(self)
+        else:
+            self.admission.release(self)
+
+    # IPushProducer, for the local transport
+
+    def pauseProducing(self):
+        # update_buffered() decides, against high_water
+        pass
+
+    def resumeProducing(self):
+        self.local_backlogged = False
+        self.update_buffered()
+
+    def stopProducing(self):
+        pass
+
+    def hold_window(self):
+        """Return whether to keep the SSH window from growing for now."""
+        if self.client is None or self.local_backlogged or self.flow.paused:
+            self.window_held = True
+        return self.window_held
+
+    def update_buffered(self):
+        """Recount what this channel buffers, then pause or resume."""
+        if self not in self.flow.channels:
+            return
+        buffered = self.buf_bytes + self.local_buf_bytes
+        if getattr(self, 'client', None) is not None:
+            backlog = _write_backlog(self.client.transport)
+            if backlog > self.flow.high_water:
+                self.local_backlogged = True
+            buffered += backlog
+        if buffered != self.buffered:
+            delta, self.buffered = buffered - self.buffered, buffered
+            self.flow.update(delta)
+        self.flow_changed()
+
+    def flow_changed(self):
+        if getattr(self, 'client', None) is None or self.localClosed:
+            return
+        if not self.reading_paused and (self.buf_bytes > self.flow.high_water
+                                        or self.flow.paused):
+            self.reading_paused = True
+            self.client.transport.pauseProducing()
+        elif (self.reading_paused and not self.flow.paused and
+              self.buf_bytes <= self.flow.low_water):
+            self.reading_paused = False
+            self.client.transport.resumeProducing()
+        if (self.window_held and not self.local_backlogged and
+                not self.flow.paused):
+            self.window_held = False
+            if self.localWindowLeft < self.localWindowSize:
+                self.conn.adjustWindow(
+                    self, self.localWindowSize - self.localWindowLeft)
+
+    def _grow_window(self, received):
+        self.epoch_bytes += received
+        now = time.time()
+        if now - self.epoch_start < (self.conn.rtt or DEFAULT_RTT):
+            return
+        if self.epoch_bytes * 2 >= self.localWindowSize:
+            grown = min(self.localWindowSize * self.WINDOW_GROWTH,
+                        self.max_window)
+            logger.debug("growing window of %s to %d bytes", self, grown)
+            extra = grown - self.localWindowSize
+            self.localWindowSize = grown
+            self.conn.adjustWindow(self, extra)
+        self.epoch_start = now
+        self.epoch_bytes = 0
+
+
 class NullChannel(channel.SSHChannel):
 
     name = 'session'
@@ -263,8 +999,6 @@ class NullChannel(channel.SSHChannel):
 Tunnel handling:
 """
 
-open_tunnels = 0
-
 def connect_tunnel(tunnel_id,
                    base_url,
                    username,
@@ -275,31 +1009,63 @@ def connect_tunnel(tunnel_id,
                    connected_callback,
                    error_callback,
                    shutdown_callback,
-                   diagnostic):
+                   diagnostic,
+                   multiplex=False,
+                   ssh_port=22,
+                   settings=None,
+                   flow_control=None,
+                   pool=None,
+                   admission=None):
+    """
+    Forward each (local port, remote port) pair in ports from remote_host
+    to local_host. By default every pair gets its own SSH connection; with
+    multiplex they all share one. settings is a ChannelSettings, and
+    flow_control the FlowControl, pool the LocalConnectionPool and
+    admission the AdmissionControl shared by all the connections; a pool
+    and admission control are made if settings ask for them. Return a list
+    of Deferreds firing with each TunnelTransport.
+    """
+    flow_control = flow_control or FlowControl(settings)
+    if pool is None and settings and settings.pool_size:
+        pool = LocalConnectionPool(settings)
+    if admission is None and settings and settings.max_channels:
+        admission = AdmissionControl(settings)
+    open_tunnels = [0]
 
     def check_n_call():
-        global open_tunnels
-        open_tunnels += 1
-        if open_tunnels >= len(ports) and connected_callback:
+        open_tunnels[0] += 1
+        if open_tunnels[0] >= len(ports) and connected_callback:
             connected_callback()
 
     def eb(failure):
         logger.warning(str(failure))
         if error_callback:
             error_callback()
-    for (local_port, remote_port) in ports:
+
+    if multiplex:
+        groups = [ports]
+    else:
+        groups = [[pair] for pair in ports]
+    deferreds = []
+    for forward_ports in groups:
         df = protocol.ClientCreator(reactor,
                                     TunnelTransport,
                                     tunnel_id,
                                     username,
                                     access_key,
                                     local_host,
-                                    local_port,
-                                    remote_port,
+                                    forward_ports,
                                     check_n_call,
                                     error_callback,
-                                    diagnostic).connectTCP(remote_host, 22)
+                                    diagnostic,
+                                    settings,
+                                    flow_control,
+                                    pool,
+                                    admission).connectTCP(remote_host,
+                                                          ssh_port)
         df.addErrback(eb)
+        deferreds.append(df)
 
     reactor.addSystemEventTrigger("before", "shutdown", shutdown_callback)
+    return deferreds
 
@@ -0,0 +1,227 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Port forwarding spread over worker processes, so that encrypting and
+copying tunnel traffic can use more than one core.
+
+Each worker runs its own reactor and SSH connection(s) to the tunnel host
+for its share of the ports. The ShardedTunnel supervisor in the main
+process starts the workers and tracks their readiness and health.
+"""
+
+import os
+import sys
+import logging
+
+import simplejson
+from twisted.internet import error, protocol, reactor, stdio
+from twisted.protocols import basic
+
+import sshtunnel
+
+logger = logging.getLogger(__name__)
+
+
+def shard_ports(ports, workers):
+    """Deal ports round-robin into at most `workers` non-empty shards."""
+    workers = max(1, min(workers, len(ports)))
+    return [ports[i::workers] for i in xrange(workers)]
+
+
+def _log_config():
+    # workers log like the main process does
+    config = dict(level=logging.getLogger().level)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            config['filename'] = handler.baseFilename
+        if handler.formatter:
+            config['format'] = handler.formatter._fmt
+    return config
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, supervisor, index, config):
+        self.supervisor = supervisor
+        self.index = index
+        self.config = config
+        self.buffer = ''
+
+    def connectionMade(self):
+        self.transport.write(simplejson.dumps(self.config) + "\n")
+
+    def outReceived(self, data):
+        lines = (self.buffer + data).split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            self.supervisor.worker_event(self.index, line)
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self.index, reason)
+
+
+class ShardedTunnel:
+    """
+    Forward ports through up to `workers` processes, each holding its own
+    SSH connection(s) to remote_host for a shard of the ports. Takes the
+    same arguments as sshtunnel.connect_tunnel().
+
+    connected_callback is called once every worker has its forwards up;
+    error_callback whenever a worker loses its connection or exits.
+    """
+
+    def __init__(self, workers, tunnel_id, base_url, username, access_key,
+                 local_host, remote_host, ports, connected_callback,
+                 error_callback, shutdown_callback, diagnostic,
+                 multiplex=False, ssh_port=22, settings=None):
+        self.shards = shard_ports(ports, workers)
+        self.connected_callback = connected_callback
+        self.error_callback = error_callback
+        self.shutdown_callback = shutdown_callback
+        self.config = dict(tunnel_id=tunnel_id, username=username,
+                           access_key=access_key, local_host=local_host,
+                           remote_host=remote_host, diagnostic=diagnostic,
+                           multiplex=multiplex, ssh_port=ssh_port,
+                           settings=settings and settings.to_dict(),
+                           log=_log_config())
+        self.processes = {}
+        self.status = {}        # shard index -> starting/ready/error/exited
+        self.stopping = False
+        self.shutdown_trigger = None
+
+    def start(self):
+        path = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        for index, shard in enumerate(self.shards):
+            config = dict(self.config, ports=shard, index=index)
+            self.status[index] = 'starting'
+            self.processes[index] = reactor.spawnProcess(
+                _WorkerProtocol(self, index, config), sys.executable,
+                [sys.executable, path], env=os.environ,
+                childFDs={0: 'w', 1: 'r', 2: 2})
+        logger.info("Started %d forwarding workers for tunnel %s",
+                    len(self.shards), self.config['tunnel_id'])
+        if self.shutdown_trigger is None:
+            self.shutdown_trigger = reactor.addSystemEventTrigger(
+                "before", "shutdown", self._shutdown)
+        return self
+
+    def _shutdown(self):
+        self.shutdown_trigger = None
+        self.stop()
+        self.shutdown_callback()
+
+    def worker_event(self, index, event):
+        if event == 'ready':
+            self.status[index] = 'ready'
+            if self.is_healthy() and self.connected_callback:
+                self.connected_callback()
+                self.connected_callback = None
+        elif event == 'error':
+            self.status[index] = 'error'
+            if self.error_callback and not self.stopping:
+                self.error_callback()
+
+    def worker_ended(self, index, reason):
+        self.status[index] = 'exited'
+        if self.stopping:
+            return
+        logger.warning("Forwarding worker %d exited: %s", index,
+                       reason.value)
+        if self.error_callback:
+            self.error_callback()
+
+    def health(self):
+        """
+        Return the number of workers in each status, and the status, pid
+        and ports of every worker that isn't ready.
+        """
+        counts = {}
+        for status in self.status.values():
+            counts[status] = counts.get(status, 0) + 1
+        return dict(counts, unhealthy=[
+            dict(ports=self.shards[i], status=self.status[i],
+                 pid=self.processes[i].pid)
+            for i in xrange(len(self.shards)) if self.status[i] != 'ready'])
+
+    def is_healthy(self):
+        return all(status == 'ready' for status in self.status.values())
+
+    def stop(self):
+        """Stop the workers; a stopped tunnel has nothing to do at exit."""
+        self.stopping = True
+        if self.shutdown_trigger is not None:
+            reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self.shutdown_trigger = None
+        for process in self.processes.values():
+            try:
+                process.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
+
+
+class _Worker(basic.LineReceiver):
+    """Worker side: read the config, forward, and report back."""
+
+    delimiter = "\n"
+
+    def lineReceived(self, line):
+        config = simplejson.loads(line)
+        log = config['log']
+        logging.basicConfig(level=log['level'], filename=log.get('filename'),
+                            format=log.get('format', "%(message)s"))
+        ports = [tuple(pair) for pair in config['ports']]
+        settings = None
+        if config['settings']:
+            settings = sshtunnel.ChannelSettings(
+                **dict((str(k), v) for k, v in config['settings'].items()))
+        logger.info("Worker %d forwarding ports %s", config['index'], ports)
+        flow_control = sshtunnel.FlowControl(settings)
+        sshtunnel.log_stats("Forwarding buffers", flow_control.stats)
+        pool = None
+        if settings and settings.pool_size:
+            pool = sshtunnel.LocalConnectionPool(settings)
+            sshtunnel.log_stats("Local connection pool", pool.stats)
+        admission = None
+        if settings and settings.max_channels:
+            admission = sshtunnel.AdmissionControl(settings)
+            sshtunnel.log_stats("Admission control", admission.stats)
+        sshtunnel.connect_tunnel(
+            str(config['tunnel_id']), None, str(config['username']),
+            str(config['access_key']), str(config['local_host']),
+            str(config['remote_host']), ports,
+            lambda: self.sendLine('ready'),
+            lambda: self.sendLine('error'),
+            lambda: None, config['diagnostic'], config['multiplex'],
+            config['ssh_port'], settings, flow_control, pool, admission)
+
+    def connectionLost(self, reason):
+        # the supervisor went away
+        if reactor.running:
+            reactor.stop()
+
+
+if __name__ == '__main__':
+    stdio.StandardIO(_Worker())
+    reactor.run()
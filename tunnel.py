@@ -22,23 +22,33 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
 import sys
 import logging
 import re
+import signal
 import socket
 from optparse import OptionParser
 
 import daemon
+import simplejson
 from twisted.internet import reactor
 
+import ratelimit
 import saucerest
 import sshtunnel
-from tunnelmonitor import get_new_tunnel, Heartbeat
+import sshworkers
+from tunnelmonitor import (
+    get_new_tunnel, reattach_tunnel, Heartbeat, StandbyPool)
 
 logger = logging.getLogger("tunnel")
 
 tunnel_id = None
 
+# set by SIGUSR1: exit without deleting the tunnel machine, so the next
+# process can pick it up with --reattach
+restarting = False
+
 
 def _parse_options():
     op = OptionParser(
@@ -65,8 +75,75 @@ def _parse_options():
     op.add_option("-b", "--baseurl", dest="base_url",
                   default="https://saucelabs.com",
                   help="use an alternate base URL for the saucelabs service")
+    op.add_option("--rate-limit", default=0, type="float",
+                  help="share a budget of RATE_LIMIT REST requests per second"
+                       " with the other tunnel.py processes on this machine"
+                       " using the same --rate-limit-file")
+    op.add_option("--rate-limit-file", default=ratelimit.default_path(),
+                  help="file holding the shared rate limit state"
+                       " [default: %default]")
+    op.add_option("--state-file",
+                  help="record the tunnel ID, host, domains and ports in"
+                       " STATE_FILE. Send SIGUSR1 to exit leaving the tunnel"
+                       " machine running for the next process")
+    op.add_option("--reattach", default=False, action='store_true',
+                  help="reuse the tunnel recorded in --state-file if it is"
+                       " still running, instead of launching a new one")
+    op.add_option("--multiplex", default=False, action='store_true',
+                  help="forward every port over a single SSH connection"
+                       " instead of one connection per port")
+    op.add_option("--workers", default=0, type="int",
+                  help="spread the forwarded ports over WORKERS processes,"
+                       " each with its own SSH connection, to use more"
+                       " cores")
+    op.add_option("--window-size", type="int",
+                  help="SSH channel window in KB for forwarded connections"
+                       " [default: 128]")
+    op.add_option("--max-packet", type="int",
+                  help="largest SSH packet in KB the tunnel host may send"
+                       " [default: 32]")
+    op.add_option("--max-window", type="int",
+                  help="let channel windows grow up to MAX_WINDOW KB while"
+                       " they limit throughput, for high latency links")
+    op.add_option("--high-water", default=256, type="int",
+                  help="KB a forwarded connection may buffer in either"
+                       " direction before it stops taking more"
+                       " [default: %default]")
+    op.add_option("--low-water", default=64, type="int",
+                  help="KB a paused forwarded connection drains to before"
+                       " it resumes [default: %default]")
+    op.add_option("--max-buffered", type="int",
+                  help="KB all forwarded connections may buffer together"
+                       " (per worker with --workers) before they all pause")
+    op.add_option("--pool-size", default=0, type="int",
+                  help="keep POOL_SIZE connections to each local port open"
+                       " ahead of time, for forwarded connections to use")
+    op.add_option("--pool-idle", default=30, type="float",
+                  help="replace pooled connections unused for this many"
+                       " seconds [default: %default]")
+    op.add_option("--connect-timeout", default=30, type="float",
+                  help="seconds to wait for a connection to the local host"
+                       " [default: %default]")
+    op.add_option("--max-connections", type="int",
+                  help="forward at most this many connections to each local"
+                       " port at once; more wait for their turn")
+    op.add_option("--max-queued", default=100, type="int",
+                  help="with --max-connections, connections that may wait"
+                       " per local port before more are refused"
+                       " [default: %default]")
+    op.add_option("--queue-timeout", default=30, type="float",
+                  help="close connections that waited this many seconds"
+                       " [default: %default]")
+    op.add_option("--standby", default=0, type="int",
+                  help="keep STANDBY booted tunnels in reserve to take over"
+                       " at once if the tunnel fails")
+    op.add_option("--standby-max-idle", type="float",
+                  help="shut down the standby tunnels once they have been"
+                       " idle this many machine-hours in total")
 
     options, args = op.parse_args()
+    if options.reattach and not options.state_file:
+        op.error("--reattach requires --state-file")
 
     num_missing = 5 - len(args)
     if num_missing > 0:
@@ -121,6 +198,42 @@ def run_diagnostic(domains, ports, local_host):
         sys.exit(1)
 
 
+def save_state(path, tunnel, domains, ports):
+    state = dict(id=tunnel['id'], Host=tunnel['Host'], DomainNames=domains,
+                 ports=ports)
+    # write and rename, so a crash never leaves a half-written file
+    temp = "%s.%d" % (path, os.getpid())
+    f = open(temp, 'wb')
+    try:
+        simplejson.dump(state, f)
+    finally:
+        f.close()
+    os.rename(temp, path)
+
+
+def load_state(path):
+    """Return the recorded tunnel state, or None if there is none."""
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            return simplejson.load(f)
+        except ValueError:
+            logger.warning("Ignoring unreadable state file %s", path)
+            return None
+    finally:
+        f.close()
+
+
+def remove_state(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 def connect_tunnel(options, tunnel, tunnel_change_callback):
     drop_readyfile = None
     if options.readyfile:
@@ -133,6 +246,7 @@ def connect_tunnel(options, tunnel, tunnel_change_callback):
 
 
 def main(options, args, ports):
+    global tunnel_id
     username = args[0]
     access_key = args[1]
     local_host = args[2]
@@ -144,8 +258,21 @@ def main(options, args, ports):
     if options.diagnostic:
         run_diagnostic(domains, ports, local_host)
 
+    rate_limiter = None
+    if options.rate_limit:
+        try:
+            rate_limiter = ratelimit.SharedRateLimiter(
+                options.rate_limit_file, rate=options.rate_limit,
+                burst=max(1, 2 * options.rate_limit))
+        except (IOError, OSError), e:
+            logger.error("Exiting: Could not use rate limit file %s: %s",
+                         options.rate_limit_file, e)
+            sys.exit(1)
+
     sauce_client = saucerest.SauceClient(name=username, access_key=access_key,
-                                         base_url=options.base_url)
+                                         base_url=options.base_url,
+                                         cache_size=64,
+                                         rate_limiter=rate_limiter)
 
     if sauce_client.get_tunnel("test-authorized")['error'] == 'Unauthorized':
         logger.error("Exiting: Incorrect username or access key")
@@ -153,35 +280,125 @@ def main(options, args, ports):
 
     def disconnected_callback(tunnel_id):
         logger.warning("tunnel %s disconnected, marking unhealthy", tunnel_id)
-        sauce_client.unhealthy_tunnels.add(tunnel_id)
+        sauce_client.mark_tunnel_unhealthy(tunnel_id)
+
+    def shutdown_callback(tunnel_id):
+        if not restarting:
+            sauce_client.delete_tunnel(tunnel_id)
+
+    sharded_tunnels = []
+    kb = lambda size: size and size * 1024
+    settings = sshtunnel.ChannelSettings(kb(options.window_size),
+                                         kb(options.max_packet),
+                                         kb(options.max_window),
+                                         kb(options.high_water),
+                                         kb(options.low_water),
+                                         kb(options.max_buffered),
+                                         options.pool_size,
+                                         options.pool_idle,
+                                         options.connect_timeout,
+                                         options.max_connections,
+                                         options.max_queued,
+                                         options.queue_timeout)
+    flow_control = sshtunnel.FlowControl(settings)
+    pool = None
+    admission = None
+    if not options.workers:
+        sshtunnel.log_stats("Forwarding buffers", flow_control.stats)
+        if options.pool_size:
+            pool = sshtunnel.LocalConnectionPool(settings)
+            sshtunnel.log_stats("Local connection pool", pool.stats)
+        if options.max_connections:
+            admission = sshtunnel.AdmissionControl(settings)
+            sshtunnel.log_stats("Admission control", admission.stats)
+    else:
+        sshtunnel.log_stats("Forwarding workers", lambda: [
+            sharded.health() for sharded in sharded_tunnels])
 
     def tunnel_change_callback(new_tunnel, connected_callback=None):
         global tunnel_id
         tunnel_id = new_tunnel['id']
-        sshtunnel.connect_tunnel(
-            tunnel_id, sauce_client.base_url, username, access_key, local_host,
-            new_tunnel['Host'], ports, connected_callback,
-            lambda t=tunnel_id: disconnected_callback(t),
-            lambda t=tunnel_id: sauce_client.delete_tunnel(t),
-            options.diagnostic)
-
+        if options.state_file:
+            save_state(options.state_file, new_tunnel, domains, ports)
+        args = (tunnel_id, sauce_client.base_url, username, access_key,
+                local_host, new_tunnel['Host'], ports, connected_callback,
+                lambda t=tunnel_id: disconnected_callback(t),
+                lambda t=tunnel_id: shutdown_callback(t),
+                options.diagnostic, options.multiplex)
+        if not options.workers:
+            sshtunnel.connect_tunnel(*args, settings=settings,
+                                     flow_control=flow_control, pool=pool,
+                                     admission=admission)
+            return
+        # workers forwarding to the old tunnel host have nothing left to do
+        while sharded_tunnels:
+            sharded_tunnels.pop().stop()
+        sharded_tunnels.append(
+            sshworkers.ShardedTunnel(options.workers, *args,
+                                     settings=settings).start())
+
+    def restart_handler(signum, frame):
+        global restarting
+        logger.warning("Restart requested, leaving tunnel %s running",
+                       tunnel_id)
+        restarting = True
+        reactor.callFromThread(reactor.stop)
+
+    if options.state_file:
+        signal.signal(signal.SIGUSR1, restart_handler)
+
+    standby_pool = None
     try:
-        max_tries = 1000
-        if not options.shutdown:
-            max_tries = 1
-        tunnel = get_new_tunnel(sauce_client, domains,
-                                replace=options.shutdown,
-                                max_tries=max_tries)
+        tunnel = None
+        state = options.reattach and load_state(options.state_file)
+        if state:
+            tunnel = reattach_tunnel(sauce_client, state['id'], domains)
+            if tunnel:
+                logger.info("Reattached to tunnel %s", tunnel['id'])
+        if not tunnel:
+            max_tries = 1000
+            if not options.shutdown:
+                max_tries = 1
+            tunnel = get_new_tunnel(sauce_client, domains,
+                                    replace=options.shutdown,
+                                    max_tries=max_tries)
         connect_tunnel(options, tunnel, tunnel_change_callback)
-        h = Heartbeat(sauce_client, tunnel_id, tunnel_change_callback)
+        if options.standby:
+            standby_pool = StandbyPool(sauce_client, options.standby,
+                                       options.standby_max_idle)
+            standby_pool.maintain()
+        h = Heartbeat(sauce_client, tunnel_id, tunnel_change_callback,
+                      standby_pool=standby_pool)
         h.start()
         reactor.run()
         logger.warning("Reactor stopped")
         h.done = True
         h.join()
+        if h.tunnel_id != tunnel_id:
+            # the heartbeat replaced the tunnel while the reactor stopped
+            tunnel_id = h.tunnel_id
+            if restarting:
+                save_state(options.state_file,
+                           sauce_client.get_tunnel(tunnel_id), domains, ports)
     finally:
-        logger.warning("Exiting")
-        sauce_client.delete_tunnel(tunnel_id)
+        if standby_pool:
+            standby_pool.close()
+        if restarting:
+            logger.warning("Exiting for restart")
+        else:
+            logger.warning("Exiting")
+            sauce_client.delete_tunnel(tunnel_id)
+            if options.state_file:
+                remove_state(options.state_file)
+        logger.info("REST cache: %s", sauce_client.cache.stats())
+        if pool:
+            logger.info("Local connection pool: %s", pool.stats())
+        if admission:
+            logger.info("Admission control: %s", admission.stats())
+        if rate_limiter:
+            logger.info("Rate limiter waits: %s", rate_limiter.stats())
+        for sharded in sharded_tunnels:
+            logger.info("Forwarding workers: %s", sharded.health())
 
 
 if __name__ == '__main__':
@@ -24,10 +24,11 @@
 
 import sys
 import time
+import socket
 import logging
 import threading
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, threads
 
 import saucerest
 
@@ -46,38 +47,174 @@ def _do_user_shutdown(sauce_client, tunnel_id):
         sys.exit(0)
 
 
-def _get_running_tunnel(sauce_client, tunnel_id):
+def probe_ssh_banner(host, port=22, timeout=1):
+    """Return whether host:port answers with an SSH banner."""
+    sock = socket.socket()
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect((host, port))
+            return sock.recv(4096).startswith("SSH-")
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+
+
+def is_tunnel_usable(tunnel, probe_timeout=1):
     """
-    Wait up to TIMEOUT seconds for tunnel to have "running" status. Return
-    running tunnel or None if timeout is reached.
+    Return whether tunnel info describes a tunnel that can be forwarded
+    through: running, or still booting but already answering SSH. With
+    probe_timeout=None only a running tunnel counts. This is the same
+    rule SauceClient.is_tunnel_healthy() applies.
     """
-    last_status = None
-    for _ in xrange(TIMEOUT / RETRY_TIME):
-        tunnel = sauce_client.get_tunnel(tunnel_id)
-        assert tunnel['id'] == tunnel_id, \
-            "Tunnel info should have same ID as the one requested"
+    status = tunnel.get('Status')
+    if status not in saucerest.USABLE_TUNNEL_STATUSES:
+        return False
+    if status == "running":
+        return True
+    return bool(probe_timeout and tunnel.get('Host') and
+                probe_ssh_banner(tunnel['Host'], timeout=probe_timeout))
 
-        if tunnel['Status'] != last_status:
-            logger.info("Status: %s", tunnel['Status'])
-            last_status = tunnel['Status']
 
-        if tunnel['Status'] == "running":
-            return tunnel
-        elif tunnel['Status'] == 'terminated':
-            if 'UserShutDown' in tunnel:
-                _do_user_shutdown(sauce_client, tunnel['id'])
-            logger.warning("Tunnel is terminated")
-            sauce_client.delete_tunnel(tunnel['id'])
+class ReadinessWaiter:
+    """
+    Wait for a new tunnel to be ready to forward through.
+
+    The tunnel's status is polled min_interval apart at first, backing off
+    by `backoff` up to max_interval, for up to timeout seconds. While it is
+    booting, its host is also probed for an SSH banner, and an answer ends
+    the wait early. The time until the tunnel was ready is recorded as the
+    "tunnel_ready" event in the client's metrics.
+
+    Use wait() to block, or deferred() to wait from the reactor thread.
+    Both give the tunnel info, which has status "terminated" if the tunnel
+    died, or None on timeout.
+    """
+
+    def __init__(self, sauce_client, tunnel_id, timeout=TIMEOUT,
+                 min_interval=0.25, max_interval=RETRY_TIME, backoff=1.5,
+                 probe=True):
+        self.sauce_client = sauce_client
+        self.tunnel_id = tunnel_id
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.probe = probe
+        self.interval = min_interval
+        self.tunnel = None
+        self.started = time.time()
+
+    def check(self):
+        """Poll once; return whether the wait is over."""
+        tunnel = self.sauce_client.get_tunnel(self.tunnel_id, fresh=True)
+        assert tunnel['id'] == self.tunnel_id, \
+            "Tunnel info should have same ID as the one requested"
+        status = tunnel['Status']
+        if self.tunnel is None or status != self.tunnel['Status']:
+            logger.info("Status: %s", status)
+        self.tunnel = tunnel
+
+        if status == "terminated":
+            return True
+        if is_tunnel_usable(tunnel,
+                            self.probe and min(1, self.max_interval) or None):
+            if status == "running":
+                self._ready("status")
+            else:
+                self._ready("SSH banner while %s" % status)
+            return True
+        return False
+
+    def _ready(self, how):
+        elapsed = time.time() - self.started
+        logger.info("Tunnel ready after %.1fs (%s)", elapsed, how)
+        if self.sauce_client.metrics is not None:
+            self.sauce_client.metrics.observe_event('tunnel_ready', elapsed)
+
+    def _next_interval(self):
+        """Return seconds until the next check, or None if out of time."""
+        interval = self.interval
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        remaining = self.started + self.timeout - time.time()
+        if remaining <= 0:
+            logger.warning("Timed out after waiting ~%ds for running tunnel",
+                           self.timeout)
             return None
-        time.sleep(RETRY_TIME)
+        return min(interval, remaining)
 
-    logger.warning("Timed out after waiting ~%ds for running tunnel", TIMEOUT)
-    return None
+    def wait(self):
+        while not self.check():
+            interval = self._next_interval()
+            if interval is None:
+                return None
+            time.sleep(interval)
+        return self.tunnel
+
+    def deferred(self):
+        """Like wait(), but return a Deferred; checks run in a thread."""
+        result = defer.Deferred()
+
+        def check():
+            d = threads.deferToThread(self.check)
+            d.addCallbacks(checked, result.errback)
+
+        def checked(done):
+            if done:
+                return result.callback(self.tunnel)
+            interval = self._next_interval()
+            if interval is None:
+                return result.callback(None)
+            reactor.callLater(interval, check)
+
+        check()
+        return result
+
+
+def _get_running_tunnel(sauce_client, tunnel_id):
+    """
+    Wait up to TIMEOUT seconds for tunnel to be ready. Return running
+    tunnel or None if it terminated or timeout is reached.
+    """
+    tunnel = ReadinessWaiter(sauce_client, tunnel_id).wait()
+    if tunnel is not None and tunnel['Status'] == 'terminated':
+        if 'UserShutDown' in tunnel:
+            _do_user_shutdown(sauce_client, tunnel['id'])
+        logger.warning("Tunnel is terminated")
+        sauce_client.delete_tunnel(tunnel['id'])
+        return None
+    return tunnel
+
+
+def reattach_tunnel(sauce_client, tunnel_id, domains):
+    """
+    Return the info of tunnel_id if it is still usable and serves every
+    one of domains, so a restarted process can reuse it; otherwise None.
+    """
+    try:
+        tunnel = sauce_client.get_tunnel(tunnel_id, fresh=True)
+    except saucerest.SauceRestError, e:
+        logger.warning("Could not check tunnel %s: %s", tunnel_id, e)
+        return None
+    if 'UserShutDown' in tunnel or not is_tunnel_usable(tunnel):
+        logger.info("Tunnel %s is no longer running", tunnel_id)
+        return None
+    if not set(domains) <= set(tunnel.get('DomainNames') or ()):
+        logger.info("Tunnel %s serves other domains: %s", tunnel_id,
+                    tunnel.get('DomainNames'))
+        return None
+    return tunnel
 
 
 def get_new_tunnel(sauce_client, domains, replace=True, max_tries=1000):
     tunnel = None
     tries = 0
+    # with tries of its own, this loop is the retry budget; the client's
+    # retries on top would multiply it
+    creator = sauce_client
+    if max_tries != 1:
+        creator = sauce_client.single_try()
     while not tunnel:
         tries += 1
         trymsg = ("(try #%d)" % tries) if tries > 1 else ""
@@ -89,7 +226,7 @@ def get_new_tunnel(sauce_client, domains, replace=True, max_tries=1000):
 
         logger.info("Launching tunnel ... %s", trymsg)
         try:
-            tunnel = sauce_client.create_tunnel({'DomainNames': domains})
+            tunnel = creator.create_tunnel({'DomainNames': domains})
         except saucerest.SauceRestError, e:
             tunnel = dict(
                 error="Unable to connect to REST interface: %s" % str(e))
@@ -102,7 +239,7 @@ def get_new_tunnel(sauce_client, domains, replace=True, max_tries=1000):
                     reactor.stop()
                 else:
                     sys.exit(1)
-            time.sleep(RETRY_TIME)
+            sauce_client.retry_policy.wait(tries)
             tunnel = None
         else:
             try:
@@ -116,6 +253,185 @@ def get_new_tunnel(sauce_client, domains, replace=True, max_tries=1000):
     return tunnel
 
 
+class StandbyPool:
+    """
+    Booted tunnels without domains, kept in reserve so a failed tunnel can
+    be replaced at once by pointing a standby at its domains, instead of
+    booting a new machine.
+
+    Up to `size` standbys are kept; maintain() refills the pool in the
+    background. If max_idle_hours is given, standbys may sit idle that
+    many machine-hours in total; after that they are shut down and the
+    pool stays empty.
+    """
+
+    def __init__(self, sauce_client, size=1, max_idle_hours=None):
+        self.sauce_client = sauce_client
+        self.size = size
+        self.max_idle = max_idle_hours and max_idle_hours * 3600.0
+        self.lock = threading.Condition()
+        self.standbys = []      # (tunnel, time it became ready)
+        self.pending = 0
+        self.creating = 0       # create_tunnel() calls in flight
+        self.booting = set()    # IDs of created tunnels not ready yet
+        self.idle_spent = 0.0   # idle machine-seconds of former standbys
+        self.exhausted = False
+        self.closed = False
+
+    def idle_seconds(self):
+        """Machine-seconds standbys have spent idle so far."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            return self.idle_spent + sum(now - ready
+                                         for _, ready in self.standbys)
+        finally:
+            self.lock.release()
+
+    def _take(self):
+        self.lock.acquire()
+        try:
+            if not self.standbys:
+                return None
+            tunnel, ready = self.standbys.pop(0)
+            self.idle_spent += time.time() - ready
+            return tunnel
+        finally:
+            self.lock.release()
+
+    def _delete(self, tunnel_id):
+        try:
+            self.sauce_client.delete_tunnel(tunnel_id)
+        except saucerest.SauceRestError, e:
+            logger.warning("Could not shut down standby tunnel %s: %s",
+                           tunnel_id, e)
+
+    def maintain(self):
+        """Enforce the idle budget and start refilling the pool if short."""
+        if self.max_idle and not self.exhausted and \
+                self.idle_seconds() >= self.max_idle:
+            logger.warning("Standby tunnels used up their %g machine-hours,"
+                           " shutting them down", self.max_idle / 3600)
+            self.exhausted = True
+            self.drain()
+        self.lock.acquire()
+        try:
+            missing = 0
+            if not (self.closed or self.exhausted):
+                missing = self.size - len(self.standbys) - self.pending
+                self.pending += max(0, missing)
+                self.creating += max(0, missing)
+        finally:
+            self.lock.release()
+        for _ in xrange(missing):
+            thread = threading.Thread(target=self._add_standby)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _add_standby(self):
+        tunnel_id = tunnel = None
+        closed = False
+        try:
+            try:
+                tunnel = self.sauce_client.create_tunnel({'DomainNames': []})
+                if 'error' in tunnel:
+                    raise saucerest.SauceRestError(tunnel['error'])
+                tunnel_id = tunnel['id']
+            finally:
+                # from here on close() knows to shut the tunnel down
+                self.lock.acquire()
+                try:
+                    self.creating -= 1
+                    if tunnel_id is not None:
+                        self.booting.add(tunnel_id)
+                    closed = self.closed
+                    self.lock.notifyAll()
+                finally:
+                    self.lock.release()
+            if not closed:
+                tunnel = ReadinessWaiter(self.sauce_client, tunnel_id).wait()
+        except Exception, e:
+            logger.warning("Could not launch standby tunnel: %s", e)
+            tunnel = None
+
+        self.lock.acquire()
+        try:
+            self.pending -= 1
+            # close() may have taken the tunnel over already
+            owned = tunnel_id in self.booting
+            self.booting.discard(tunnel_id)
+            keep = (owned and not closed and tunnel is not None and
+                    tunnel['Status'] != 'terminated' and
+                    not (self.closed or self.exhausted))
+            if keep:
+                self.standbys.append((tunnel, time.time()))
+        finally:
+            self.lock.release()
+        if keep:
+            logger.info("Standby tunnel %s ready", tunnel_id)
+        elif owned:
+            self._delete(tunnel_id)
+
+    def promote(self, domains):
+        """
+        Point a standby tunnel at domains and return its info, or None if
+        no standby is usable. The pool is refilled in the background.
+        """
+        try:
+            while True:
+                tunnel = self._take()
+                if tunnel is None:
+                    return None
+                try:
+                    self.sauce_client.update_tunnel(tunnel['id'],
+                                                    {'DomainNames': domains})
+                    tunnel = self.sauce_client.get_tunnel(tunnel['id'],
+                                                          fresh=True)
+                except saucerest.SauceRestError, e:
+                    logger.warning("Could not promote standby tunnel %s: %s",
+                                   tunnel['id'], e)
+                else:
+                    if is_tunnel_usable(tunnel) and \
+                            set(domains) <= set(tunnel.get('DomainNames')
+                                                or ()):
+                        logger.info("Promoted standby tunnel %s",
+                                    tunnel['id'])
+                        return tunnel
+                    logger.warning("Standby tunnel %s is unusable",
+                                   tunnel['id'])
+                self._delete(tunnel['id'])
+        finally:
+            self.maintain()
+
+    def drain(self):
+        """Shut down every standby tunnel."""
+        while True:
+            tunnel = self._take()
+            if tunnel is None:
+                return
+            self._delete(tunnel['id'])
+
+    def close(self, timeout=30):
+        """
+        Shut down every standby, including those still booting. Waits up
+        to timeout seconds for tunnels still being created, so that none
+        is left running once the process exits.
+        """
+        deadline = time.time() + timeout
+        self.lock.acquire()
+        try:
+            self.closed = True
+            while self.creating and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            booting = list(self.booting)
+            self.booting.clear()
+        finally:
+            self.lock.release()
+        for tunnel_id in booting:
+            self._delete(tunnel_id)
+        self.drain()
+
+
 def exc_to_const(f, exc=Exception, const=False):
     def inner(*a, **k):
         try:
@@ -130,12 +446,13 @@ def exc_to_const(f, exc=Exception, const=False):
 
 class Heartbeat(threading.Thread):
     def __init__(self, sauce_client, tunnel_id, update_callback,
-                 max_tries=1000):
+                 max_tries=1000, standby_pool=None):
         threading.Thread.__init__(self)
         self.sauce_client = sauce_client
         self.tunnel_id = tunnel_id
         self.update_callback = update_callback
         self.max_tries = max_tries
+        self.standby_pool = standby_pool
         self.done = False
         self.interval = RETRY_TIME
 
@@ -150,24 +467,28 @@ class Heartbeat(threading.Thread):
     def heartbeat(self):
         is_tunnel_healthy = exc_to_const(self.sauce_client.is_tunnel_healthy)
         self.sauce_client.prune_unhealthy_tunnels([self.tunnel_id])
+        if self.standby_pool:
+            self.standby_pool.maintain()
         if not is_tunnel_healthy(self.tunnel_id):
             running = False
             tries = 0
+            # the loop below does the retrying, with the client's backoff
+            once = self.sauce_client.single_try()
             while not self.done:
                 tries += 1
                 try:
-                    tunnel = self.sauce_client.get_tunnel(self.tunnel_id)
+                    tunnel = once.get_tunnel(self.tunnel_id, fresh=True)
 
                     if 'UserShutDown' in tunnel:
                         _do_user_shutdown(self.sauce_client, self.tunnel_id)
                         return
 
-                    if tunnel['Status'] == "running":
+                    if is_tunnel_usable(tunnel):
                         running = True
                         break
 
                     logger.info("Tunnel is down")
-                    self.sauce_client.delete_tunnel(self.tunnel_id)
+                    once.delete_tunnel(self.tunnel_id)
                 except saucerest.SauceRestError, e:
                     logger.critical(
                         "Unable to connect to REST interface at %s: %s",
@@ -180,7 +501,7 @@ class Heartbeat(threading.Thread):
                         else:
                             sys.exit(1)
 
-                    time.sleep(RETRY_TIME)
+                    self.sauce_client.retry_policy.wait(tries)
                 else:
                     break
 
@@ -188,8 +509,15 @@ class Heartbeat(threading.Thread):
                 return
 
             logger.info("Replacing tunnel")
-            new_tunnel = get_new_tunnel(self.sauce_client,
-                                        tunnel['DomainNames'])
+            new_tunnel = None
+            if self.standby_pool:
+                # the domains have to be free before a standby can take them
+                self.sauce_client.delete_tunnels_by_domains(
+                    tunnel['DomainNames'])
+                new_tunnel = self.standby_pool.promote(tunnel['DomainNames'])
+            if new_tunnel is None:
+                new_tunnel = get_new_tunnel(self.sauce_client,
+                                            tunnel['DomainNames'])
             self.tunnel_id = new_tunnel['id']
 
             if self.update_callback:
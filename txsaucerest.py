@@ -0,0 +1,209 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009-2010 Sauce Labs Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# 'Software'), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Twisted-native SauceREST client.
+
+Same surface as saucerest.SauceClient, but every call returns a Deferred
+and runs on the reactor. Requests go over a pool of persistent keep-alive
+connections to base_url, and at most max_connections are in flight at
+once.
+"""
+
+import base64
+import urllib
+import logging
+
+import simplejson
+from zope.interface import implements
+from twisted.internet import defer, reactor as default_reactor
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
+
+from saucerest import SauceRestError, _loads
+
+logger = logging.getLogger(__name__)
+
+
+class _StringProducer(object):
+    implements(IBodyProducer)
+
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+class AsyncSauceClient:
+    """Non-blocking wrapper class for operations with Sauce"""
+
+    def __init__(self, name=None, access_key=None,
+                 base_url="https://saucelabs.com",
+                 timeout=30,
+                 max_connections=8,
+                 reactor=None):
+        if base_url.endswith('/'):
+            base_url = base_url[:-1]
+        self.base_url = base_url
+        self.account_name = name
+        self.timeout = timeout
+        self.reactor = reactor or default_reactor
+        self.auth = "Basic " + base64.b64encode("%s:%s" % (name, access_key))
+
+        self.pool = HTTPConnectionPool(self.reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_connections
+        self.agent = Agent(self.reactor, connectTimeout=timeout,
+                           pool=self.pool)
+        # Caps the requests in flight to base_url; the pool only caps how
+        # many idle connections are kept around.
+        self.semaphore = defer.DeferredSemaphore(max_connections)
+
+    def close(self):
+        """Drop the idle keep-alive connections. Returns a Deferred."""
+        return self.pool.closeCachedConnections()
+
+    def _url(self, type, *parts, **parameters):
+        url = self.base_url + "/rest/%s/%s" % (self.account_name, type)
+        for part in parts:
+            url += "/%s" % part
+        if parameters:
+            url += "?%s" % urllib.urlencode(parameters)
+        return url
+
+    def _http_request(self, uri, method, body=None, headers=None):
+        """
+        Issue the request once a connection slot is free. Fires with
+        (response, content); failures errback with SauceRestError.
+        """
+        return self.semaphore.run(self._do_http_request,
+                                  uri, method, body, headers or {})
+
+    def _do_http_request(self, uri, method, body, headers):
+        request_headers = Headers({'Authorization': [self.auth]})
+        for key, value in headers.iteritems():
+            request_headers.setRawHeaders(key, [value])
+        producer = None
+        if body is not None:
+            producer = _StringProducer(body)
+
+        d = self.agent.request(method, uri, request_headers, producer)
+        timeout_call = self.reactor.callLater(self.timeout, d.cancel)
+
+        def read_body(response):
+            return readBody(response).addCallback(
+                lambda content: (response, content))
+
+        def cancel_timeout(result):
+            if timeout_call.active():
+                timeout_call.cancel()
+            return result
+
+        def eb(failure):
+            raise SauceRestError("HTTP request failed for %s: %s"
+                                 % (self.base_url, failure.getErrorMessage()))
+
+        d.addCallback(read_body)
+        d.addBoth(cancel_timeout)
+        d.addErrback(eb)
+        return d
+
+    def get(self, type, doc_id, **kwargs):
+        headers = {"Content-Type": "application/json"}
+        parts = [doc_id]
+        attachment = kwargs.pop('attachment', None)
+        if attachment:
+            parts.append(attachment)
+        url = self._url(type, *parts, **kwargs)
+        d = self._http_request(url, 'GET', headers=headers)
+        if attachment:
+            return d.addCallback(lambda (response, content): content)
+        return d.addCallback(lambda (response, content): _loads(content))
+
+    def list(self, type):
+        headers = {"Content-Type": "application/json"}
+        d = self._http_request(self._url(type), 'GET', headers=headers)
+        return d.addCallback(lambda (response, content): _loads(content))
+
+    def create(self, type, body):
+        headers = {"Content-Type": "application/json"}
+        d = self._http_request(self._url(type), 'POST',
+                               body=simplejson.dumps(body),
+                               headers=headers)
+        return d.addCallback(lambda (response, content): _loads(content))
+
+    def attach(self, doc_id, name, body):
+        d = self._http_request(self._url('scripts', doc_id, name), 'PUT',
+                               body=body)
+        return d.addCallback(lambda (response, content): _loads(content))
+
+    def delete(self, type, doc_id):
+        headers = {"Content-Type": "application/json"}
+        d = self._http_request(self._url(type, doc_id), 'DELETE',
+                               headers=headers)
+        return d.addCallback(lambda (response, content): _loads(content))
+
+    #------ Sauce-specific objects ------
+
+    # Scripts
+
+    def create_script(self, body):
+        return self.create('scripts', body)
+
+    def get_script(self, script_id):
+        return self.get('scripts', doc_id=script_id)
+
+    # Jobs
+
+    def create_job(self, body):
+        return self.create('jobs', body)
+
+    def get_job(self, job_id):
+        return self.get('jobs', job_id)
+
+    def list_jobs(self):
+        return self.list('jobs')
+
+    # Tunnels
+
+    def create_tunnel(self, body):
+        return self.create('tunnels', body)
+
+    def get_tunnel(self, tunnel_id):
+        return self.get('tunnels', tunnel_id)
+
+    def list_tunnels(self):
+        return self.list('tunnels')
+
+    def delete_tunnel(self, tunnel_id):
+        return self.delete('tunnels', tunnel_id)